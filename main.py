@@ -8,7 +8,7 @@ from pathlib import Path
 
 import click
 
-from src import proj_path, vocabulary_path, dataset_path, assets_path
+from src import proj_path, vocabulary_path, dataset_path, labeled_path, assets_path, inference_path
 
 
 @click.group()
@@ -111,14 +111,265 @@ def train(
 
 
 @cli.command()
+@click.pass_context
 @click.option("--host", default="0.0.0.0", type=str, help="host")
 @click.option("--port", default=8000, type=int, help="port")
-def app(host: str, port: int):
+@click.option("--max-batch-size", default=16, type=int, help="max batch size of dynamic batching")
+@click.option("--max-wait-ms", default=5.0, type=float, help="max wait time(ms) to gather a batch")
+@click.option("--max-workers", default=32, type=int, help="max concurrent inference threads")
+@click.option("--max-pending", default=256, type=int, help="max pending requests before returning 503")
+@click.option("-w", "--workers", default=1, type=int, help="number of worker processes")
+@click.option("-t", "--cpu-threads", default=1, type=int, help="cpu math threads per worker")
+@click.option("--backend", default="paddle", type=click.Choice(["paddle", "onnx"]), help="inference backend")
+@click.option("--model-registry", type=Path, help="model registry directory, defaults to the inference directory")
+@click.option("--model-version", type=str, help="pin a model version instead of following the registry")
+@click.option("--watch-interval", default=0, type=float, help="poll the registry every N seconds for a new version")
+@click.option("--shadow-version", type=str, help="shadow model version, disagreements are logged")
+@click.option("--cascade-model", type=Path, help="simple-mode model answering first, e.g. inference/simple/model")
+@click.option("--cascade-threshold", default=0.9, type=float, help="fall back to the full model below this confidence")
+@click.option("--batch-buckets", default="1,4,8,16,32", type=str, help="pad batches to these sizes, empty to disable")
+@click.option("--warmup-batch-sizes", default="1,2,4,8,16", type=str, help="batch sizes to warm up without buckets")
+@click.option("--cache-size", default=10000, type=int, help="max cached predictions in memory, 0 to disable")
+@click.option("--cache-ttl", default=3600, type=float, help="cached prediction ttl(s), <=0 never expires")
+@click.option("--cache-path", type=Path, help="sqlite file of the on-disk prediction cache")
+@click.option("--access-log-sample", default=1.0, type=float, help="sample rate of access logs for normal requests")
+@click.option("--slow-ms", default=500, type=float, help="requests slower than this(ms) are always logged")
+@click.option("--log-predictions/--no-log-predictions", default=True, help="whether to log predictions in access logs")
+@click.option("--capture-path", type=Path, help="append sampled and slow requests to this capture file for replay")
+@click.option("--capture-sample", default=0.01, type=float, help="sample rate of captured requests")
+@click.option("--profile", default=inference_path / "profile.json", type=Path, help="engine profile written by tune")
+def app(
+    ctx: click.Context,
+    host: str,
+    port: int,
+    max_batch_size: int,
+    max_wait_ms: float,
+    max_workers: int,
+    max_pending: int,
+    workers: int,
+    cpu_threads: int,
+    backend: str,
+    model_registry: Path,
+    model_version: str,
+    watch_interval: float,
+    shadow_version: str,
+    cascade_model: Path,
+    cascade_threshold: float,
+    batch_buckets: str,
+    warmup_batch_sizes: str,
+    cache_size: int,
+    cache_ttl: float,
+    cache_path: Path,
+    access_log_sample: float,
+    slow_ms: float,
+    log_predictions: bool,
+    capture_path: Path,
+    capture_sample: float,
+    profile: Path,
+):
     """run the app"""
-    import uvicorn
-    from src.app import app as m_app
+    import os
+
+    # 服务配置通过环境变量传递给src.app.settings
+    os.environ["CAPTCHA_CPU_THREADS"] = str(cpu_threads)
+    os.environ["CAPTCHA_BACKEND"] = backend
+    if model_registry:
+        os.environ["CAPTCHA_MODEL_REGISTRY"] = str(model_registry)
+    if model_version is not None:
+        os.environ["CAPTCHA_MODEL_VERSION"] = model_version
+    os.environ["CAPTCHA_MODEL_WATCH_INTERVAL"] = str(watch_interval)
+    if shadow_version:
+        os.environ["CAPTCHA_SHADOW_VERSION"] = shadow_version
+    if cascade_model:
+        os.environ["CAPTCHA_CASCADE_MODEL"] = str(cascade_model)
+    os.environ["CAPTCHA_CASCADE_THRESHOLD"] = str(cascade_threshold)
+    os.environ["CAPTCHA_BATCH_BUCKETS"] = batch_buckets
+    os.environ["CAPTCHA_WARMUP_BATCH_SIZES"] = warmup_batch_sizes
+    os.environ["CAPTCHA_MAX_BATCH_SIZE"] = str(max_batch_size)
+    os.environ["CAPTCHA_MAX_WAIT_MS"] = str(max_wait_ms)
+    os.environ["CAPTCHA_MAX_WORKERS"] = str(max_workers)
+    os.environ["CAPTCHA_MAX_PENDING"] = str(max_pending)
+    os.environ["CAPTCHA_CACHE_SIZE"] = str(cache_size)
+    os.environ["CAPTCHA_CACHE_TTL"] = str(cache_ttl)
+    if cache_path:
+        os.environ["CAPTCHA_CACHE_PATH"] = str(cache_path)
+    os.environ["CAPTCHA_ACCESS_LOG_SAMPLE"] = str(access_log_sample)
+    os.environ["CAPTCHA_SLOW_MS"] = str(slow_ms)
+    os.environ["CAPTCHA_ACCESS_LOG_PREDICTIONS"] = str(int(log_predictions))
+    if capture_path:
+        os.environ["CAPTCHA_CAPTURE_PATH"] = str(capture_path)
+    os.environ["CAPTCHA_CAPTURE_SAMPLE"] = str(capture_sample)
+    if profile and profile.is_file():
+        from click.core import ParameterSource
+        from src.app.engine import load_profile, profile_env
+
+        # 调优配置覆盖默认值，命令行显式指定的参数优先
+        values = load_profile(profile)
+        values = {k: v for k, v in values.items() if ctx.get_parameter_source(k) in (None, ParameterSource.DEFAULT)}
+        os.environ.update(profile_env(values))
+        workers = values.get("workers", workers)
+    from src.app import server
+
+    server.serve(host, port, workers=workers)
+
+
+@cli.command()
+@click.option("--model", type=Path, help="model path without suffix, defaults to the live registry version")
+@click.option("-o", "--output", default=inference_path / "profile.json", type=Path, help="profile file")
+@click.option("--threads", default="", type=str, help="comma separated cpu threads to try, defaults to 1,2,4,.. cores")
+@click.option("--batch-sizes", default="1,4,8,16,32", type=str, help="comma separated batch sizes to try")
+@click.option("--max-latency-ms", default=100, type=float, help="max p99 latency(ms) of one batch")
+@click.option("--seconds", default=1.0, type=float, help="benchmark seconds per configuration")
+@click.option("--backend", default="paddle", type=click.Choice(["paddle", "onnx"]), help="inference backend")
+def tune(
+    model: Path, output: Path, threads: str, batch_sizes: str, max_latency_ms: float, seconds: float, backend: str
+):
+    """benchmark engine options on this machine and write the best profile"""
+    from src.app import tune as m_tune
+
+    m_tune.tune(
+        model or _live_model(),
+        output,
+        threads=[int(t) for t in threads.split(",") if t.strip()],
+        batch_sizes=[int(b) for b in batch_sizes.split(",") if b.strip()],
+        max_latency_ms=max_latency_ms,
+        seconds=seconds,
+        backend=backend,
+    )
+
+
+def _live_model() -> Path:
+    """模型仓库中上线版本的模型路径"""
+    from src.app.registry import ModelRegistry
+
+    registry = ModelRegistry(inference_path)
+    return registry.model_path(registry.target())
+
+
+@cli.command()
+@click.option("--model", type=Path, help="model path without suffix, defaults to the live registry version")
+@click.option("--opset", default=13, type=int, help="onnx opset version")
+def export_onnx(model: Path, opset: int):
+    """convert the paddle inference model to onnx next to it"""
+    from src.app.engine import export_onnx as m_export_onnx
+
+    save_file = m_export_onnx(model or _live_model(), opset_version=opset)
+    click.echo(f"Exported to {save_file}")
+
+
+@cli.command()
+@click.option("--model", type=Path, help="model path without suffix, defaults to the live registry version")
+@click.option("-o", "--output", type=Path, required=True, help="pruned model path prefix, e.g. inference/v3/model")
+@click.option("--chars", type=Path, default=labeled_path / "words_dict.txt", help="file of characters to keep")
+def export_pruned(model: Path, output: Path, chars: Path):
+    """prune the output layer and vocabulary to a character set"""
+    from src.app import prune as m_prune
+    from src.app.engine import model_vocabulary
+    from src.helper.vocabulary import load_vocabulary
+
+    model = model or _live_model()
+    vocabulary = load_vocabulary(model_vocabulary(model) or vocabulary_path)
+    with open(chars, encoding="utf-8") as f:
+        m_prune.prune_vocabulary(model, output, [w.strip() for w in f], vocabulary)
+    click.echo(f"Exported to {output}")
+
+
+@cli.command()
+@click.option("--model", type=Path, help="model path without suffix, defaults to the live registry version")
+@click.option("--images", type=Path, help="directory of captcha images used for the parity check")
+@click.option("--batch-sizes", default="1,4,8,16,32", type=str, help="comma separated batch sizes to benchmark")
+@click.option("-t", "--cpu-threads", default=1, type=int, help="cpu math threads")
+@click.option("--seconds", default=1.0, type=float, help="benchmark seconds per configuration")
+def bench_backends(model: Path, images: Path, batch_sizes: str, cpu_threads: int, seconds: float):
+    """compare parity and speed of the paddle and onnx backends"""
+    from PIL import Image
+    from src.app import tune as m_tune
+    from src.app.engine import model_vocabulary
+    from src.helper.util import DataUtil
+    from src.helper.decoder import Decoder
+
+    model = model or _live_model()
+    data_util = DataUtil(model_vocabulary(model) or vocabulary_path)
+    batch = None
+    if images:
+        paths = sorted(p for p in images.iterdir() if p.suffix.lower() in (".png", ".jpg", ".jpeg"))[:256]
+        assert paths, f"no images found in {images}"
+        batch = data_util.process_batch([data_util.load_rgb(Image.open(p)) for p in paths])
+    m_tune.compare_backends(
+        model,
+        Decoder(data_util.get_vocabulary()),
+        batch_sizes=[int(b) for b in batch_sizes.split(",") if b.strip()],
+        cpu_threads=cpu_threads,
+        seconds=seconds,
+        images=batch,
+    )
+
+
+@cli.command()
+@click.option("--model", type=Path, help="model path without suffix, defaults to the live registry version")
+@click.option("-o", "--output", type=Path, required=True, help="int8 model path prefix, e.g. inference/v3/model")
+@click.option("--dataset-dirs", type=str, default=str(dataset_path / "labeled"), help="comma separated dataset dirs")
+@click.option("--vocabulary", type=Path, help="vocabulary file, defaults to the one next to the model")
+@click.option(
+    "--channel", default="text", type=click.Choice(["text", "red", "blue", "black", "yellow"]), help="channel"
+)
+@click.option("--data-type", type=click.Choice(["color", "single"]), default="color", help="data type")
+@click.option("--max-len", type=int, default=6, help="max length of captcha")
+@click.option("--calib-num", default=160, type=int, help="test samples used for calibration")
+@click.option("--eval-num", default=0, type=int, help="test samples used for evaluation, 0 means all")
+@click.option("-b", "--batch-size", default=16, type=int, help="batch size of calibration and benchmark")
+@click.option("--algo", default="KL", type=click.Choice(["KL", "hist", "avg", "mse", "emd", "abs_max"]), help="algo")
+@click.option("-t", "--cpu-threads", default=1, type=int, help="cpu math threads of the benchmark")
+@click.option("--seconds", default=1.0, type=float, help="benchmark seconds per model")
+def quantize(
+    model: Path,
+    output: Path,
+    dataset_dirs: str,
+    vocabulary: Path,
+    channel: str,
+    data_type: str,
+    max_len: int,
+    calib_num: int,
+    eval_num: int,
+    batch_size: int,
+    algo: str,
+    cpu_threads: int,
+    seconds: float,
+):
+    """post-training int8 quantization, calibrated on the labeled test split"""
+    from src.app import quantize as m_quantize
+    from src.app.engine import model_vocabulary
+    from src.helper.util import DataUtil
+
+    model = model or _live_model()
+    vocabulary = vocabulary or model_vocabulary(model) or vocabulary_path
+    dirs = [d for d in dataset_dirs.split(",") if d.strip()]
+    images, labels = m_quantize.load_samples(dirs, vocabulary, channel, data_type, max_len, eval_num)
+    calib = images[:calib_num]
+    m_quantize.quantize(model, output, calib, batch_size, batch_nums=-(-len(calib) // batch_size), algo=algo)
+    m_quantize.compare(
+        model,
+        output,
+        images,
+        labels,
+        DataUtil(str(vocabulary), max_len=max_len).get_vocabulary(),
+        batch_size=batch_size,
+        cpu_threads=cpu_threads,
+        seconds=seconds,
+    )
+
+
+@cli.command()
+@click.argument("capture_path", type=Path)
+@click.option("--url", default="http://127.0.0.1:8000", type=str, help="server url")
+@click.option("--speed", default=1.0, type=float, help="replay speed, 2 means 2x faster, <=0 means max concurrency")
+@click.option("-c", "--concurrency", default=16, type=int, help="max concurrent requests")
+@click.option("-n", "--limit", default=0, type=int, help="max requests to replay, 0 means all")
+def replay(capture_path: Path, url: str, speed: float, concurrency: int, limit: int):
+    """replay a capture file against a server"""
+    from src.helper import replay as m_replay
 
-    uvicorn.run(m_app.app, host=host, port=port)
+    m_replay.replay(url, str(capture_path), speed=speed, concurrency=concurrency, limit=limit)
 
 
 @cli.command()
@@ -0,0 +1,160 @@
+#! -*- coding: utf-8 -*-
+"""
+@Desc: 异步采样访问日志，请求线程只入队，后台线程批量序列化写入
+"""
+import os
+import json
+import time
+import atexit
+import random
+import logging
+import zipfile
+import threading
+from collections import deque
+from logging.handlers import RotatingFileHandler
+
+from src.app.metrics import ACCESS_LOG_DROPPED
+from src.app.settings import WORKER_ID_ENV
+
+
+def _zip_namer(name: str) -> str:
+    return name + ".zip"
+
+
+def worker_path(path: str) -> str:
+    """多worker时每个worker写各自的文件，如logs/access.1.log，轮转只由唯一的写入进程完成"""
+    worker = os.getenv(WORKER_ID_ENV)
+    if worker is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.{worker}{ext}"
+
+
+def _zip_rotator(source: str, dest: str):
+    # 轮转出的日志压缩保存
+    with zipfile.ZipFile(dest, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.write(source, os.path.basename(source))
+    os.remove(source)
+
+
+class AccessLog:
+    """访问日志
+    path: 日志文件，按大小轮转并压缩，多worker时各worker写带编号的文件
+    sample_rate: 正常请求的采样比例，出错和慢请求总是记录
+    slow_ms: 慢请求阈值（毫秒）
+    predictions: 是否记录预测结果
+    flush_interval: 后台线程批量写入的间隔（秒）
+    max_pending: 待写入记录上限，超出后丢弃
+    """
+
+    def __init__(
+        self,
+        path: str,
+        sample_rate: float = 1.0,
+        slow_ms: float = 500,
+        predictions: bool = True,
+        flush_interval: float = 1.0,
+        max_pending: int = 100000,
+    ):
+        assert 0 <= sample_rate <= 1, "sample_rate must be in [0, 1]"
+        self.path = path
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.predictions = predictions
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._records = deque()
+        self._handler = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def should_log(self, status: int, latency_ms: float) -> bool:
+        if status >= 400 or latency_ms >= self.slow_ms:
+            return True
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def record(self, record: dict):
+        """记录一条访问日志，只做入队，不做格式化"""
+        if not self.predictions:
+            record.pop("prediction", None)
+        if len(self._records) >= self.max_pending:
+            ACCESS_LOG_DROPPED.inc()
+            return
+        self._ensure_started()
+        self._records.append(record)
+
+    def _ensure_started(self):
+        # 写入线程延迟启动，fork出的子进程里也能重新拉起
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="access-log", daemon=True)
+                self._thread.start()
+
+    def _open(self) -> RotatingFileHandler:
+        # 在fork后的写入线程中打开，此时才能确定worker编号
+        path = worker_path(self.path)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        handler = RotatingFileHandler(path, maxBytes=10 * 1024 * 1024, backupCount=100, encoding="utf-8")
+        handler.namer = _zip_namer
+        handler.rotator = _zip_rotator
+        return handler
+
+    def flush(self):
+        """把已入队的记录一次性序列化写入"""
+        lines = []
+        while True:
+            try:
+                lines.append(json.dumps(self._records.popleft(), ensure_ascii=False, default=str))
+            except IndexError:
+                break
+        if not lines:
+            return
+        with self._lock:
+            if self._handler is None:
+                self._handler = self._open()
+            self._handler.emit(logging.makeLogRecord({"msg": "\n".join(lines)}))
+
+    def _run(self):
+        atexit.register(self.flush)
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+
+class AccessLogMiddleware:
+    """纯ASGI中间件，请求结束后按采样规则记录访问日志
+    接口可通过request.state.access附加字段，如文件名和预测结果
+    """
+
+    def __init__(self, app, access_log: AccessLog):
+        self.app = app
+        self.access_log = access_log
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        st = time.perf_counter()
+        status = [500]
+
+        async def _send(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            latency_ms = (time.perf_counter() - st) * 1000
+            if self.access_log.should_log(status[0], latency_ms):
+                record = {
+                    "time": time.time(),
+                    "client": scope["client"][0] if scope.get("client") else None,
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "status": status[0],
+                    "latency_ms": round(latency_ms, 3),
+                }
+                record.update(scope.get("state", {}).get("access") or {})
+                self.access_log.record(record)
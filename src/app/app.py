@@ -6,46 +6,540 @@
 @Author: zhayongchun
 @Date: 2023/12/20
 """
-import base64
-import io
+import hmac
+import json
+import time
+import asyncio
+import tarfile
+import zipfile
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Iterator, List, Optional, Tuple, Union
 
-from PIL import Image
 from loguru import logger
 from pydantic import BaseModel
-from fastapi import UploadFile, File, FastAPI, Request
+from fastapi import UploadFile, File, FastAPI, Request, Query, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.datastructures import UploadFile as StarletteUploadFile
 
-from src.app.predict import predict
+from src.app import metrics
+from src.app.settings import settings
+from src.app.access_log import AccessLog, AccessLogMiddleware
+from src.app.capture import CaptureMiddleware, CaptureWriter
+from src.app.cache import PredictionCache
+from src.app.codec import DecodeError, unpack_frame
+from src.app import predict
+from src.app.predict import predict_base64, predict_bytes, predict_ndarray, predict_files
+from src.app.executor import InferenceExecutor, Overloaded
+from src.app.registry import ModelNotFound
+from src.app.singleflight import SingleFlight
 
-app = FastAPI()
+
+def _warmup_done(fut: asyncio.Future):
+    if not fut.cancelled() and fut.exception() is not None:
+        logger.opt(exception=fut.exception()).error("Warmup failed, the server will never be ready")
+
+
+def _startup():
+    predict.warmup(settings.warmup_batch_sizes)
+    if settings.shadow_version:
+        predict.set_shadow(settings.shadow_version)
+    # 固定了版本时不跟随仓库更新
+    if settings.model_watch_interval > 0 and settings.model_version is None:
+        predict.watch_registry(settings.model_watch_interval)
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    # 加载和预热放到后台线程，期间存活探针正常返回，就绪探针返回503
+    task = asyncio.get_running_loop().run_in_executor(None, _startup)
+    task.add_done_callback(_warmup_done)
+    yield
+    # uvicorn因SIGTERM关闭后会重新触发该信号直接结束进程，atexit不会执行，在这里写出队列中的日志和抓包
+    flush_logs()
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(metrics.MetricsMiddleware)
+# 访问日志：按采样记录，出错和慢请求总是记录，后台线程批量写入
+access_log = AccessLog(
+    settings.access_log_path,
+    settings.access_log_sample,
+    settings.slow_ms,
+    settings.access_log_predictions,
+)
+app.add_middleware(AccessLogMiddleware, access_log=access_log)
+# 请求抓包：采样记录真实请求和耗时，慢请求总是记录，用于replay回放压测
+capture = None
+if settings.capture_path:
+    capture = CaptureWriter(settings.capture_path, settings.capture_sample, settings.slow_ms)
+    app.add_middleware(CaptureMiddleware, writer=capture)
+# 事件循环只负责I/O，解码、预处理和推理都交给有界线程池
+executor = InferenceExecutor(settings.max_workers, settings.max_pending)
+# 预测结果缓存，按原始图片字节命中，在PIL解码之前
+cache = PredictionCache(settings.cache_size, settings.cache_ttl, settings.cache_path) if settings.cache_size > 0 else None
+# 相同图片的并发请求只推理一次
+flights = SingleFlight()
 logger.add("logs/visit.log", rotation="10 MB", encoding="utf-8", enqueue=True, compression="zip", retention="100 days")
 
 
+def flush_logs():
+    """写出队列中尚未落盘的访问日志和抓包记录，在服务关闭和worker退出时调用"""
+    access_log.flush()
+    if capture is not None:
+        capture.flush()
+
+
+# 支持的颜色通道，text表示不做颜色过滤的原图
+CHANNELS = ["red", "blue", "black", "yellow", "text"]
+CHANNEL_DESC = "comma separated channels of red/blue/black/yellow/text, predicted in one batch"
+# 请求体类型对应的预测函数
+PREDICTORS = {"image": predict_bytes, "base64": predict_base64, "ndarray": predict_ndarray}
+QUERY_BEAM = Query(1, ge=1, le=32, description="beam size, greater than 1 enables prefix beam search")
+QUERY_NBEST = Query(1, ge=1, le=32, description="number of candidates returned by beam search")
+QUERY_CHANNEL = Query(None, description=CHANNEL_DESC)
+
+
 class Item(BaseModel):
     img: str
 
 
-@app.post("/api/v1/captcha/predict-by-file")
-async def upload_images(request: Request, file: UploadFile = File(...)):
-    host = request.client.host
-    logger.info(f"[{host}] visit {request.url.path}, filename: {file.filename}")
-    contents = await file.read()
-    # 将文件内容转换为字节流
-    image_stream = io.BytesIO(contents)
-    # 使用PIL库读取图片数据
-    img = Image.open(image_stream)
-    label, ci = predict(img)
-    res = {"code": 0, "data": {"filename": file.filename, "predict_label": label, "ci": ci}}
-    logger.info(f"predicts: {res}")
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request: Request, exc: Overloaded):
+    return error_response(503, "server is busy, please retry later", {"Retry-After": str(settings.retry_after)})
+
+
+@app.exception_handler(DecodeError)
+async def decode_error_handler(request: Request, exc: DecodeError):
+    return error_response(400, str(exc))
+
+
+def error_response(status_code: int, error: str, headers: Optional[dict] = None):
+    return JSONResponse(status_code=status_code, content={"code": status_code, "error": error}, headers=headers)
+
+
+def json_response(content: dict):
+    """手动序列化返回结果，统计序列化耗时"""
+    with metrics.stage_seconds["serialize"].time():
+        body = json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return Response(body, media_type="application/json")
+
+
+async def read_body(coro):
+    """读取请求体，统计读取耗时"""
+    st = time.perf_counter()
+    contents = await coro
+    metrics.stage_seconds["read"].observe(time.perf_counter() - st)
+    return contents
+
+
+def parse_channels(channel: Optional[str]) -> List[str]:
+    """解析逗号分隔的通道参数，去重并保持顺序"""
+    channels = list(dict.fromkeys(c.strip() for c in (channel or "").split(",") if c.strip()))
+    invalid = [c for c in channels if c not in CHANNELS]
+    if invalid:
+        raise ValueError(f"channel {invalid} is not supported, only can be one of {CHANNELS}")
+    return channels
+
+
+def _predict_and_cache(key: str, kind: str, contents: bytes, beam_size: int, nbest: int, channels: List[str]):
+    # 在线程池中执行：先查磁盘层，未命中再推理并写回缓存，sqlite读写不占用事件循环
+    if cache is not None:
+        res = cache.get_disk(key)
+        if res is not None:
+            metrics.cache_hit.inc()
+            return res
+        metrics.cache_miss.inc()
+    res = PREDICTORS[kind](contents, beam_size, nbest, channels)
+    if cache is not None:
+        cache.set(key, res)
     return res
 
 
-@app.post("/api/v1/captcha/predict-by-base64")
-async def upload_base64(request: Request, item: Item):
-    host = request.client.host
-    logger.info(f"[{host}] visit {request.url.path} with base64 img")
-    img = Image.open(io.BytesIO(base64.b64decode(item.img)))
-    # 使用PIL库读取图片数据
-    label, ci = predict(img)
-    res = {"code": 0, "data": {"filename": "-", "predict_label": label, "ci": ci}}
-    logger.info(f"predicts: {res}")
+async def predict_cached(
+    contents: bytes,
+    beam_size: int = 1,
+    nbest: int = 1,
+    channels: Optional[List[str]] = None,
+    kind: str = "image",
+):
+    """带缓存的预测，命中时不做任何解码和推理，相同请求体的并发请求共享一次计算
+    kind: 请求体类型，image为PNG等图片字节，base64为base64编码的图片，ndarray为打包的原始像素
+    """
+    channels = channels or []
+    # 请求体类型、模型版本、束搜索参数、通道不同结果也不同，一并作为键
+    extra = [kind] if kind != "image" else []
+    if predict.model_version:
+        extra.append(f"model={predict.model_version}")
+    if beam_size > 1:
+        extra.append(f"beam={beam_size},{nbest}")
+    if channels:
+        extra.append("channel=" + ",".join(channels))
+    if not predict.is_ready():
+        raise Overloaded("model is not ready")
+    key = PredictionCache.make_key(contents, *extra)
+    # 事件循环中只查内存层
+    res = cache.get(key) if cache is not None else None
+    if res is not None:
+        metrics.cache_hit.inc()
+    else:
+        res = await flights.do(key, executor.run, _predict_and_cache, key, kind, contents, beam_size, nbest, channels)
     return res
+
+
+@app.get("/healthz/live")
+async def healthz_live():
+    """存活探针，进程能响应即返回200"""
+    return {"code": 0}
+
+
+@app.get("/healthz/ready")
+async def healthz_ready():
+    """就绪探针，模型加载并预热完成后返回200"""
+    if not predict.is_ready():
+        return error_response(503, "model is warming up")
+    return {"code": 0}
+
+
+def check_admin(request: Request):
+    """校验管理接口的访问令牌，未配置令牌时管理接口关闭"""
+    if not settings.admin_token:
+        raise PermissionError("admin api is disabled, set CAPTCHA_ADMIN_TOKEN to enable it")
+    if not hmac.compare_digest(request.headers.get("X-Admin-Token", "").encode(), settings.admin_token.encode()):
+        raise PermissionError("invalid admin token")
+
+
+def model_info():
+    return {
+        "version": predict.model_version,
+        "target": predict.registry.target(),
+        "versions": predict.registry.versions(),
+        "shadow": predict.shadow_version,
+    }
+
+
+@app.get("/admin/model")
+async def get_model(request: Request):
+    """当前模型版本、仓库中的可用版本和影子模型版本"""
+    try:
+        check_admin(request)
+    except PermissionError as e:
+        return error_response(403, str(e))
+    return json_response({"code": 0, "data": model_info()})
+
+
+@app.post("/admin/model/reload")
+async def reload_model(request: Request, version: Optional[str] = Query(None, description="version to switch to")):
+    """热更新模型：后台加载并预热后原子替换
+    指定版本时切换成功后写入仓库的CURRENT文件，开启仓库轮询的其他worker随之切换；不指定时切换到仓库的上线版本
+    """
+    try:
+        check_admin(request)
+        await asyncio.get_running_loop().run_in_executor(None, predict.reload_model, version, version is not None)
+    except PermissionError as e:
+        return error_response(403, str(e))
+    except ModelNotFound as e:
+        return error_response(400, str(e))
+    return json_response({"code": 0, "data": model_info()})
+
+
+@app.post("/admin/model/shadow")
+async def shadow_model(request: Request, version: Optional[str] = Query(None, description="empty to disable")):
+    """设置影子模型，与线上模型跑同一批输入并记录识别结果不一致的样本"""
+    try:
+        check_admin(request)
+        await asyncio.get_running_loop().run_in_executor(None, predict.set_shadow, version)
+    except PermissionError as e:
+        return error_response(403, str(e))
+    except ModelNotFound as e:
+        return error_response(400, str(e))
+    return json_response({"code": 0, "data": model_info()})
+
+
+@app.post("/api/v1/captcha/predict-by-file")
+async def upload_images(
+    request: Request,
+    file: UploadFile = File(...),
+    beam: int = QUERY_BEAM,
+    nbest: int = QUERY_NBEST,
+    channel: Optional[str] = QUERY_CHANNEL,
+):
+    try:
+        channels = parse_channels(channel)
+    except ValueError as e:
+        return error_response(400, str(e))
+    contents = await read_body(file.read())
+    # 解码和推理在线程池中完成
+    pred = await predict_cached(contents, beam, nbest, channels)
+    request.state.access = {"filename": file.filename, "prediction": pred}
+    res = {"code": 0, "data": {"filename": file.filename, **pred}}
+    return json_response(res)
+
+
+@app.post("/api/v1/captcha/predict-by-base64")
+async def upload_base64(
+    request: Request,
+    item: Item,
+    beam: int = QUERY_BEAM,
+    nbest: int = QUERY_NBEST,
+    channel: Optional[str] = QUERY_CHANNEL,
+):
+    try:
+        channels = parse_channels(channel)
+    except ValueError as e:
+        return error_response(400, str(e))
+    pred = await predict_cached(item.img.encode(), beam, nbest, channels, kind="base64")
+    request.state.access = {"prediction": pred}
+    res = {"code": 0, "data": {"filename": "-", **pred}}
+    return json_response(res)
+
+
+@app.post("/api/v1/captcha/predict-by-bytes")
+async def upload_bytes(
+    request: Request,
+    beam: int = QUERY_BEAM,
+    nbest: int = QUERY_NBEST,
+    channel: Optional[str] = QUERY_CHANNEL,
+):
+    """请求体直接为图片字节（application/octet-stream），不经过multipart和base64"""
+    try:
+        channels = parse_channels(channel)
+    except ValueError as e:
+        return error_response(400, str(e))
+    pred = await predict_cached(await read_body(request.body()), beam, nbest, channels)
+    request.state.access = {"prediction": pred}
+    res = {"code": 0, "data": {"filename": "-", **pred}}
+    return json_response(res)
+
+
+@app.post("/api/v1/captcha/predict-by-ndarray")
+async def upload_ndarray(
+    request: Request,
+    beam: int = QUERY_BEAM,
+    nbest: int = QUERY_NBEST,
+    channel: Optional[str] = QUERY_CHANNEL,
+):
+    """请求体为打包的uint8像素（格式见src.app.codec），跳过图片解码"""
+    try:
+        channels = parse_channels(channel)
+    except ValueError as e:
+        return error_response(400, str(e))
+    pred = await predict_cached(await read_body(request.body()), beam, nbest, channels, kind="ndarray")
+    request.state.access = {"prediction": pred}
+    res = {"code": 0, "data": pred}
+    return json_response(res)
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus指标"""
+    content, content_type = metrics.render()
+    return Response(content, media_type=content_type)
+
+
+def archive_type(file: UploadFile) -> Optional[str]:
+    """根据文件名和类型判断是否为zip或tar压缩包"""
+    name = (file.filename or "").lower()
+    if name.endswith(".zip") or file.content_type in ("application/zip", "application/x-zip-compressed"):
+        return "zip"
+    if name.endswith((".tar", ".tar.gz", ".tgz")) or file.content_type in ("application/x-tar", "application/gzip"):
+        return "tar"
+    return None
+
+
+def _read_archive(file: UploadFile, kind: str) -> Iterator[Tuple[str, Union[bytes, ValueError]]]:
+    """逐个读取压缩包成员，解压是同步的，需在线程池中迭代；超过大小上限的成员不读取，以ValueError代替内容"""
+    limit = settings.max_member_size
+    if kind == "zip":
+        with zipfile.ZipFile(file.file) as zf:
+            for info in zf.infolist():
+                if info.is_dir():
+                    continue
+                name = f"{file.filename}/{info.filename}"
+                if info.file_size > limit:
+                    yield name, ValueError(f"member exceeds {limit} bytes")
+                    continue
+                # 文件头中的大小不可信，读取时再限制一次
+                with zf.open(info) as f:
+                    contents = f.read(limit + 1)
+                yield name, contents if len(contents) <= limit else ValueError(f"member exceeds {limit} bytes")
+    else:
+        with tarfile.open(fileobj=file.file, mode="r:*") as tar:
+            for member in tar:
+                if member.isfile():
+                    name = f"{file.filename}/{member.name}"
+                    if member.size > limit:
+                        yield name, ValueError(f"member exceeds {limit} bytes")
+                    else:
+                        yield name, tar.extractfile(member).read()
+
+
+async def iter_uploads(files: List[UploadFile]) -> AsyncIterator[Tuple[str, Union[bytes, ValueError]]]:
+    """逐个产出上传的图片，压缩包按成员逐个在线程池中读取，不整体加载到内存，也不阻塞事件循环"""
+    loop = asyncio.get_running_loop()
+    for file in files:
+        kind = archive_type(file)
+        if kind is None:
+            contents = await file.read(settings.max_member_size + 1)
+            yield file.filename, contents if len(contents) <= settings.max_member_size else ValueError(
+                f"file exceeds {settings.max_member_size} bytes"
+            )
+            continue
+        members = _read_archive(file, kind)
+        try:
+            while True:
+                item = await loop.run_in_executor(None, next, members, None)
+                if item is None:
+                    break
+                yield item
+        finally:
+            members.close()
+
+
+async def _run_files(files: List[Tuple[str, bytes]], beam_size: int, nbest: int, channels: List[str]):
+    # 批量任务优先级低于在线请求，排队已满时等待重试
+    while True:
+        try:
+            return await executor.run(predict_files, files, beam_size, nbest, channels)
+        except Overloaded:
+            await asyncio.sleep(settings.retry_after)
+
+
+async def run_chunk(chunk: List[Tuple[str, Union[bytes, ValueError]]], beam_size: int, nbest: int, channels: List[str]):
+    """推理一批图片，读取时已被拒绝的成员直接返回413"""
+    files = [(name, contents) for name, contents in chunk if isinstance(contents, bytes)]
+    preds = iter(await _run_files(files, beam_size, nbest, channels) if files else [])
+    return [
+        next(preds) if isinstance(contents, bytes) else {"filename": name, "code": 413, "error": str(contents)}
+        for name, contents in chunk
+    ]
+
+
+async def iter_chunks(items: AsyncIterator, size: int) -> AsyncIterator[list]:
+    chunk = []
+    async for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+async def stream_predictions(files: List[UploadFile], batch_size: int, beam_size: int, nbest: int, channels: List[str]):
+    """按固定大小分批推理，每批完成后立即输出NDJSON，同时最多只有两批图片在内存中"""
+    pending = None
+    try:
+        async for chunk in iter_chunks(iter_uploads(files), batch_size):
+            # 读取下一批的同时推理上一批
+            task = asyncio.ensure_future(run_chunk(chunk, beam_size, nbest, channels))
+            if pending is not None:
+                for res in await pending:
+                    yield json.dumps(res, ensure_ascii=False) + "\n"
+            pending = task
+        if pending is not None:
+            for res in await pending:
+                yield json.dumps(res, ensure_ascii=False) + "\n"
+    finally:
+        for file in files:
+            await file.close()
+
+
+# 批量接口自行解析multipart，文件数上限可配置；这里补上请求体的接口文档
+BATCH_REQUEST_BODY = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "required": ["files"],
+                    "properties": {"files": {"type": "array", "items": {"type": "string", "format": "binary"}}},
+                }
+            }
+        },
+    }
+}
+
+
+@app.post("/api/v1/captcha/predict-batch", openapi_extra=BATCH_REQUEST_BODY)
+async def upload_batch(
+    request: Request,
+    batch_size: int = Query(settings.max_batch_size, ge=1, le=256, description="images per inference batch"),
+    beam: int = QUERY_BEAM,
+    nbest: int = QUERY_NBEST,
+    channel: Optional[str] = QUERY_CHANNEL,
+):
+    """批量预测，支持多文件、zip或tar压缩包，每张图片一行NDJSON结果流式返回
+    multipart中的files字段单次最多CAPTCHA_MAX_UPLOAD_FILES个文件，更多图片可以打包为压缩包上传
+    """
+    if not predict.is_ready():
+        raise Overloaded("model is not ready")
+    try:
+        channels = parse_channels(channel)
+    except ValueError as e:
+        return error_response(400, str(e))
+    # 默认的request.form()最多接受1000个文件
+    form = await request.form(max_files=settings.max_upload_files)
+    files = [f for f in form.getlist("files") if isinstance(f, StarletteUploadFile)]
+    if not files:
+        await form.close()
+        return error_response(400, "no files uploaded")
+    request.state.access = {"files": len(files)}
+    return StreamingResponse(
+        stream_predictions(files, batch_size, beam, nbest, channels), media_type="application/x-ndjson"
+    )
+
+
+@app.websocket("/api/v1/captcha/ws")
+async def predict_ws(
+    websocket: WebSocket,
+    beam: int = QUERY_BEAM,
+    nbest: int = QUERY_NBEST,
+    channel: Optional[str] = QUERY_CHANNEL,
+):
+    """长连接预测：客户端发送带请求id的二进制帧（格式见src.app.codec），结果按完成顺序异步返回"""
+    await websocket.accept()
+    host = websocket.client.host
+    try:
+        channels = parse_channels(channel)
+    except ValueError as e:
+        await websocket.close(code=1003, reason=str(e))
+        return
+    logger.info(f"[{host}] connect {websocket.url.path}")
+    send_lock = asyncio.Lock()
+    inflight = asyncio.Semaphore(settings.ws_max_inflight)
+    tasks = set()
+
+    async def handle(frame: bytes):
+        request_id = None
+        try:
+            request_id, contents = unpack_frame(frame)
+            res = {"id": request_id, "code": 0, "data": await predict_cached(contents, beam, nbest, channels)}
+        except DecodeError as e:
+            res = {"id": request_id, "code": 400, "error": str(e)}
+        except Overloaded:
+            res = {"id": request_id, "code": 503, "error": "server is busy, please retry later"}
+        except Exception as e:
+            # 每一帧都要有且只有一个回复，否则客户端会一直等待该id
+            logger.exception(f"[{host}] predict failed for id {request_id}: {e}")
+            res = {"id": request_id, "code": 500, "error": str(e)}
+        finally:
+            inflight.release()
+        async with send_lock:
+            await websocket.send_text(json.dumps(res, ensure_ascii=False))
+
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            # 单连接并发达到上限时暂停读取，由TCP流控反压客户端
+            await inflight.acquire()
+            task = asyncio.ensure_future(handle(message.get("bytes") or b""))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    except WebSocketDisconnect:
+        logger.info(f"[{host}] disconnect {websocket.url.path}")
+    finally:
+        for task in tasks:
+            task.cancel()
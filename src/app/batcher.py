@@ -0,0 +1,124 @@
+#! -*- coding: utf-8 -*-
+"""
+@Desc: 动态微批调度，把并发请求合并成一个batch做一次前向
+"""
+import time
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, List, NamedTuple
+
+from loguru import logger
+
+from src.app.metrics import BATCH_QUEUE, BATCH_SIZE, PROCESS_RSS, rss_bytes, stage_seconds
+
+
+class _Call(NamedTuple):
+    """在调度线程上执行的任意调用，与batch排在同一个队列中"""
+    fn: Callable
+    args: tuple
+    fut: Future
+
+
+class BatchScheduler:
+    """动态微批调度器
+    handler: 批处理函数，输入样本列表，返回等长的结果列表
+    max_batch_size: 单批最大样本数
+    max_wait: 凑批最长等待时间（秒）
+    """
+
+    def __init__(self, handler: Callable[[List[Any]], List[Any]], max_batch_size: int = 16, max_wait: float = 0.005):
+        assert max_batch_size > 0, "max_batch_size must be positive"
+        self.handler = handler
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        # 队列中每个元素是一组[(样本, Future, 入队时间)]，同一组保证进入同一个batch；或者一个_Call
+        self._queue = queue.SimpleQueue()
+        self._carry = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, item: Any) -> Future:
+        """提交一个样本，返回对应结果的Future"""
+        return self.submit_many([item])[0]
+
+    def submit_many(self, items: List[Any]) -> List[Future]:
+        """提交一组样本，保证在同一个batch中推理，返回各自结果的Future"""
+        self._ensure_started()
+        now = time.perf_counter()
+        group = [(item, Future(), now) for item in items]
+        self._queue.put(group)
+        return [fut for _, fut, _ in group]
+
+    def call(self, fn: Callable, *args) -> Future:
+        """在调度线程上两个batch之间执行fn(*args)，返回结果的Future
+        oneDNN的kernel和primitive缓存按线程创建，预热新模型必须在实际推理的线程上完成
+        """
+        self._ensure_started()
+        fut = Future()
+        self._queue.put(_Call(fn, args, fut))
+        return fut
+
+    def _ensure_started(self):
+        # 调度线程延迟启动，fork出的子进程里也能重新拉起
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="batch-scheduler", daemon=True)
+                self._thread.start()
+
+    def _collect(self):
+        # 阻塞等待第一组样本，之后在max_wait窗口内尽量凑满一个batch，放不下的组留到下一批
+        jobs = self._carry or self._queue.get()
+        self._carry = None
+        if isinstance(jobs, _Call):
+            return jobs
+        deadline = time.monotonic() + self.max_wait
+        while len(jobs) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                group = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(group, _Call) or len(jobs) + len(group) > self.max_batch_size:
+                self._carry = group
+                break
+            jobs = jobs + group
+        BATCH_QUEUE.set(self._queue.qsize())
+        return jobs
+
+    def _run(self):
+        while True:
+            collected = self._collect()
+            if isinstance(collected, _Call):
+                self._call(collected)
+                continue
+            jobs = []
+            now = time.perf_counter()
+            for item, fut, enqueued in collected:
+                if fut.set_running_or_notify_cancel():
+                    jobs.append((item, fut))
+                    stage_seconds["queue"].observe(now - enqueued)
+            if not jobs:
+                continue
+            BATCH_SIZE.observe(len(jobs))
+            try:
+                results = self.handler([item for item, _ in jobs])
+            except Exception as e:
+                logger.exception(f"batch of {len(jobs)} failed: {e}")
+                for _, fut in jobs:
+                    fut.set_exception(e)
+                continue
+            for (_, fut), res in zip(jobs, results):
+                fut.set_result(res)
+            PROCESS_RSS.set(rss_bytes())
+
+    @staticmethod
+    def _call(call: _Call):
+        if not call.fut.set_running_or_notify_cancel():
+            return
+        try:
+            call.fut.set_result(call.fn(*call.args))
+        except Exception as e:
+            call.fut.set_exception(e)
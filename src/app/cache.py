@@ -0,0 +1,108 @@
+#! -*- coding: utf-8 -*-
+"""
+@Desc: 预测结果缓存，以原始图片字节的哈希为键，内存LRU+TTL，可选sqlite磁盘层
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Optional
+
+
+class PredictionCache:
+    """预测结果缓存
+    max_size: 内存中最多缓存的条目数，超出后按LRU淘汰
+    ttl: 过期时间（秒），小于等于0表示不过期
+    disk_path: 可选的sqlite文件路径，重启后仍可命中
+    get只查内存，可以在事件循环中调用；get_disk和set会读写sqlite，只能在线程池中调用
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 3600, disk_path: Optional[str] = None):
+        assert max_size > 0, "max_size must be positive"
+        self.max_size = max_size
+        self.ttl = ttl
+        self.disk_path = disk_path
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        # 只保护内存层，磁盘读写不持有该锁
+        self._lock = threading.Lock()
+        # 每个线程一个sqlite连接，WAL模式下读写可以并发
+        self._local = threading.local()
+
+    @staticmethod
+    def make_key(contents: bytes, *extra) -> str:
+        """原始字节的哈希，附加参数（如解码方式）一并作为键"""
+        digest = hashlib.blake2b(contents, digest_size=16).hexdigest()
+        return ":".join([digest, *map(str, extra)])
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / max(1, self.hits + self.misses)
+
+    def _expired(self, ts: float, now: float) -> bool:
+        return 0 < self.ttl <= now - ts
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite连接不能跨进程复用，fork之后按pid重新打开
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():
+            Path(self.disk_path).parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(self.disk_path, timeout=5, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, ts REAL)")
+            if self.ttl > 0:
+                db.execute("DELETE FROM cache WHERE ts < ?", (time.time() - self.ttl,))
+            self._local.db, self._local.pid = db, os.getpid()
+        return db
+
+    def _put_memory(self, key: str, value: Any, ts: float):
+        self._data[key] = (ts, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def get(self, key: str) -> Optional[Any]:
+        """只查内存，未命中且有磁盘层时再由get_disk在线程池中查询"""
+        now = time.time()
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                if not self._expired(item[0], now):
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return item[1]
+                del self._data[key]
+            if not self.disk_path:
+                self.misses += 1
+            return None
+
+    def get_disk(self, key: str) -> Optional[Any]:
+        """查磁盘层，命中后回填内存"""
+        if not self.disk_path:
+            return None
+        now = time.time()
+        row = self._conn().execute("SELECT value, ts FROM cache WHERE key = ?", (key,)).fetchone()
+        value = json.loads(row[0]) if row is not None and not self._expired(row[1], now) else None
+        with self._lock:
+            if value is not None:
+                self._put_memory(key, value, row[1])
+                self.hits += 1
+            else:
+                self.misses += 1
+        return value
+
+    def set(self, key: str, value: Any):
+        now = time.time()
+        with self._lock:
+            self._put_memory(key, value, now)
+        if self.disk_path:
+            self._conn().execute(
+                "INSERT OR REPLACE INTO cache (key, value, ts) VALUES (?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), now),
+            )
@@ -0,0 +1,180 @@
+#! -*- coding: utf-8 -*-
+"""
+@Desc: 请求抓包，按采样把真实请求体、响应和耗时追加写入紧凑的二进制文件，供replay回放压测
+
+文件格式：文件头FILE_MAGIC，之后逐条记录，每条为RECORD_HEADER加上
+path、query、content-type、请求体、响应体，长度均由记录头给出
+"""
+import os
+import time
+import atexit
+import random
+import struct
+import threading
+from collections import deque
+from typing import Iterator, NamedTuple
+
+FILE_MAGIC = b"CAPT\x01"
+# 时间戳、耗时(ms)、状态码、path/query/content-type长度、请求体长度、响应体长度
+RECORD_HEADER = struct.Struct("<dfHHHHII")
+
+
+class CaptureRecord(NamedTuple):
+    time: float
+    latency_ms: float
+    status: int
+    path: str
+    query: str
+    content_type: str
+    body: bytes
+    response: bytes
+
+
+def pack_record(rec: CaptureRecord) -> bytes:
+    path, query, content_type = rec.path.encode(), rec.query.encode(), rec.content_type.encode()
+    header = RECORD_HEADER.pack(
+        rec.time, rec.latency_ms, rec.status, len(path), len(query), len(content_type), len(rec.body), len(rec.response)
+    )
+    return b"".join((header, path, query, content_type, rec.body, rec.response))
+
+
+def iter_records(path: str) -> Iterator[CaptureRecord]:
+    """逐条读取抓包文件，末尾写了一半的记录直接忽略"""
+    with open(path, "rb") as f:
+        assert f.read(len(FILE_MAGIC)) == FILE_MAGIC, f"{path} is not a capture file"
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            t, latency_ms, status, *sizes = RECORD_HEADER.unpack(header)
+            fields = [f.read(size) for size in sizes]
+            if any(len(field) != size for field, size in zip(fields, sizes)):
+                return
+            path_, query, content_type, body, response = fields
+            yield CaptureRecord(
+                t, latency_ms, status, path_.decode(), query.decode(), content_type.decode(), body, response
+            )
+
+
+class CaptureWriter:
+    """抓包写入器，请求线程只入队，后台线程批量追加写入
+    path: 抓包文件，多个worker以追加方式写同一个文件
+    sample_rate: 正常请求的采样比例，慢请求和5xx总是记录
+    slow_ms: 慢请求阈值（毫秒）
+    max_body: 请求体或响应体超过该大小时不记录
+    """
+
+    def __init__(
+        self,
+        path: str,
+        sample_rate: float = 0.01,
+        slow_ms: float = 500,
+        max_body: int = 1 << 20,
+        flush_interval: float = 1.0,
+        max_pending: int = 1000,
+    ):
+        assert 0 <= sample_rate <= 1, "sample_rate must be in [0, 1]"
+        self.path = path
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.max_body = max_body
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._records = deque()
+        self._thread = None
+        self._lock = threading.Lock()
+        # 文件头在fork前由主进程写入，worker只追加记录
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            with open(path, "wb") as f:
+                f.write(FILE_MAGIC)
+
+    def should_capture(self, status: int, latency_ms: float) -> bool:
+        if status >= 500 or latency_ms >= self.slow_ms:
+            return True
+        return random.random() < self.sample_rate
+
+    def record(self, rec: CaptureRecord):
+        if len(self._records) >= self.max_pending:
+            return
+        self._ensure_started()
+        self._records.append(rec)
+
+    def _ensure_started(self):
+        # 写入线程延迟启动，fork出的子进程里也能重新拉起
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="capture", daemon=True)
+                self._thread.start()
+
+    def flush(self):
+        chunks = []
+        while True:
+            try:
+                chunks.append(pack_record(self._records.popleft()))
+            except IndexError:
+                break
+        if chunks:
+            # 一次write追加整批记录，多个进程同时写也不会交错
+            with open(self.path, "ab") as f:
+                f.write(b"".join(chunks))
+
+    def _run(self):
+        atexit.register(self.flush)
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+
+class CaptureMiddleware:
+    """纯ASGI中间件，记录预测接口的请求体、响应体和耗时"""
+
+    def __init__(self, app, writer: CaptureWriter, prefix: str = "/api/"):
+        self.app = app
+        self.writer = writer
+        self.prefix = prefix
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or not scope["path"].startswith(self.prefix):
+            return await self.app(scope, receive, send)
+        st = time.perf_counter()
+        # 只保存各分片的引用，超过大小上限后放弃记录
+        body, response = [], []
+        size = [0, 0]
+        status = [500]
+
+        async def _receive():
+            message = await receive()
+            if message["type"] == "http.request" and size[0] <= self.writer.max_body:
+                body.append(message.get("body", b""))
+                size[0] += len(body[-1])
+            return message
+
+        async def _send(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            elif message["type"] == "http.response.body" and size[1] <= self.writer.max_body:
+                response.append(message.get("body", b""))
+                size[1] += len(response[-1])
+            await send(message)
+
+        try:
+            await self.app(scope, _receive, _send)
+        finally:
+            latency_ms = (time.perf_counter() - st) * 1000
+            if max(size) <= self.writer.max_body and self.writer.should_capture(status[0], latency_ms):
+                headers = dict(scope["headers"])
+                self.writer.record(
+                    CaptureRecord(
+                        time=time.time() - latency_ms / 1000,
+                        latency_ms=latency_ms,
+                        status=status[0],
+                        path=scope["path"],
+                        query=scope.get("query_string", b"").decode(),
+                        content_type=headers.get(b"content-type", b"").decode(),
+                        body=b"".join(body),
+                        response=b"".join(response),
+                    )
+                )
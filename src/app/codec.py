@@ -0,0 +1,70 @@
+#! -*- coding: utf-8 -*-
+"""
+@Desc: 请求体编解码
+原始像素的批量打包格式：头部 <IHHB 依次为图片数N、高H、宽W、通道数C（3或4），
+其后紧跟N*H*W*C字节的uint8像素（HWC排列），服务端用np.frombuffer零拷贝读取
+WebSocket二进制帧格式：头部 <I 为客户端自定的请求id，其后为图片字节
+"""
+import io
+import base64
+import struct
+import binascii
+
+import numpy as np
+from PIL import Image
+
+NDARRAY_HEADER = struct.Struct("<IHHB")
+FRAME_HEADER = struct.Struct("<I")
+
+
+class DecodeError(ValueError):
+    """请求体无法解码为图片"""
+
+
+def decode_image(contents: bytes) -> Image.Image:
+    """解码图片字节，Image.open只读取文件头，这里立即解码像素，损坏或截断的图片在此处报错"""
+    try:
+        img = Image.open(io.BytesIO(contents))
+        img.load()
+    except (OSError, Image.DecompressionBombError) as e:
+        raise DecodeError(f"cannot decode image: {e}")
+    return img
+
+
+def decode_base64(data: bytes) -> bytes:
+    """严格解码base64，含非法字符或长度不对时报错"""
+    try:
+        return base64.b64decode(data, validate=True)
+    except binascii.Error as e:
+        raise DecodeError(f"invalid base64: {e}")
+
+
+def pack_ndarray(pixels: np.ndarray) -> bytes:
+    """[N,H,W,C]的uint8像素打包为请求体"""
+    assert pixels.ndim == 4 and pixels.dtype == np.uint8, "pixels must be a uint8 array of [N,H,W,C]"
+    return NDARRAY_HEADER.pack(*pixels.shape) + np.ascontiguousarray(pixels).tobytes()
+
+
+def unpack_ndarray(body: bytes) -> np.ndarray:
+    """请求体解包为[N,H,W,C]的只读uint8数组，不拷贝像素"""
+    if len(body) < NDARRAY_HEADER.size:
+        raise DecodeError("body too short for ndarray header")
+    n, h, w, c = NDARRAY_HEADER.unpack_from(body)
+    if c not in (3, 4):
+        raise DecodeError(f"channels must be 3 or 4, got {c}")
+    size = n * h * w * c
+    if len(body) != NDARRAY_HEADER.size + size:
+        raise DecodeError(f"body size {len(body)} mismatch with header {(n, h, w, c)}")
+    return np.frombuffer(body, dtype=np.uint8, count=size, offset=NDARRAY_HEADER.size).reshape(n, h, w, c)
+
+
+def pack_frame(request_id: int, contents: bytes) -> bytes:
+    """图片字节加上请求id打包为WebSocket二进制帧"""
+    return FRAME_HEADER.pack(request_id) + contents
+
+
+def unpack_frame(frame: bytes):
+    """WebSocket二进制帧解包为(请求id, 图片字节)"""
+    if len(frame) < FRAME_HEADER.size:
+        raise DecodeError("frame too short for request id")
+    return FRAME_HEADER.unpack_from(frame)[0], frame[FRAME_HEADER.size:]
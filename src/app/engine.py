@@ -0,0 +1,186 @@
+#! -*- coding: utf-8 -*-
+"""
+@Desc: 推理后端（Paddle Inference、ONNX Runtime）的创建和调优配置，配置文件由main.py tune生成，main.py app启动时加载
+"""
+import os
+import json
+from pathlib import Path
+
+import numpy as np
+from loguru import logger
+
+# 裁剪过输出层的模型目录中带有自己的词表
+VOCABULARY_FILE = "vocabulary.txt"
+
+# 配置项对应的服务环境变量
+PROFILE_ENV = {
+    "backend": "CAPTCHA_BACKEND",
+    "cpu_threads": "CAPTCHA_CPU_THREADS",
+    "max_batch_size": "CAPTCHA_MAX_BATCH_SIZE",
+    "batch_buckets": "CAPTCHA_BATCH_BUCKETS",
+    "use_mkldnn": "CAPTCHA_USE_MKLDNN",
+    "ir_optim": "CAPTCHA_IR_OPTIM",
+    "memory_optim": "CAPTCHA_MEMORY_OPTIM",
+}
+
+
+class Backend:
+    """推理后端接口，输入[N,3,H,W]的float32，返回[N,T,C]的logits
+    path: 模型路径前缀，不含后缀，各后端按自己的格式补全
+    """
+
+    name = ""
+    # 模型自带的词表，为空时使用全局词表
+    vocabulary_path: Path = None
+
+    def __call__(self, batch: np.ndarray, batch_size: int = None) -> np.ndarray:
+        raise NotImplementedError
+
+
+def model_vocabulary(path: Path):
+    """模型同目录下的词表文件，不存在时返回None"""
+    vocab = Path(path).parent / VOCABULARY_FILE
+    return vocab if vocab.is_file() else None
+
+
+def is_quantized(path: Path) -> bool:
+    """是否为main.py quantize生成的INT8模型，量化模型中带有quantize_linear算子"""
+    return b"quantize_linear" in Path(path).with_suffix(".pdmodel").read_bytes()
+
+
+class PaddleBackend(Backend):
+    """Paddle Inference后端
+    ir_optim: 是否做计算图优化（算子融合等）
+    memory_optim: 是否复用中间结果的内存
+    INT8模型在开启mkldnn时转换为INT8算子执行，否则按FP32模拟量化执行
+    """
+
+    name = "paddle"
+
+    def __init__(
+        self,
+        path: Path,
+        cpu_threads: int = 1,
+        use_mkldnn: bool = True,
+        ir_optim: bool = True,
+        memory_optim: bool = False,
+    ):
+        from ppqi import InferenceModel
+
+        self.model = InferenceModel(modelpath=str(path), use_gpu=False, use_mkldnn=use_mkldnn, cpu_threads=cpu_threads)
+        # ppqi在eval时才根据config创建predictor，之前可以调整引擎选项
+        self.model.config.switch_ir_optim(ir_optim)
+        if use_mkldnn and is_quantized(path):
+            self.model.config.enable_mkldnn_int8()
+        if memory_optim:
+            self.model.config.enable_memory_optim()
+        self.model.eval()
+
+    def __call__(self, batch: np.ndarray, batch_size: int = None) -> np.ndarray:
+        # ppqi默认按batch_size=1切分输入，这里默认整批前向
+        return self.model(batch, batch_size=batch_size or len(batch))
+
+
+class OnnxBackend(Backend):
+    """ONNX Runtime后端，模型由export_onnx从Paddle模型转换得到
+    ir_optim: 是否开启全部图优化；use_mkldnn和memory_optim对该后端无效
+    """
+
+    name = "onnx"
+
+    def __init__(
+        self,
+        path: Path,
+        cpu_threads: int = 1,
+        use_mkldnn: bool = True,
+        ir_optim: bool = True,
+        memory_optim: bool = False,
+    ):
+        import onnxruntime as ort
+
+        onnx_path = Path(path).with_suffix(".onnx")
+        assert onnx_path.is_file(), f"{onnx_path} not found, export it with `python main.py export-onnx` first"
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = cpu_threads
+        options.inter_op_num_threads = 1
+        level = ort.GraphOptimizationLevel
+        options.graph_optimization_level = level.ORT_ENABLE_ALL if ir_optim else level.ORT_DISABLE_ALL
+        self.session = ort.InferenceSession(str(onnx_path), options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, batch: np.ndarray, batch_size: int = None) -> np.ndarray:
+        return self.session.run(None, {self.input_name: batch})[0]
+
+
+BACKENDS = {backend.name: backend for backend in (PaddleBackend, OnnxBackend)}
+
+
+def create_model(
+    path: Path,
+    cpu_threads: int = 1,
+    use_mkldnn: bool = True,
+    ir_optim: bool = True,
+    memory_optim: bool = False,
+    backend: str = "paddle",
+) -> Backend:
+    """创建CPU推理后端
+    path: 模型路径前缀，不含.pdmodel/.onnx后缀
+    backend: paddle或onnx
+    """
+    assert backend in BACKENDS, f"backend {backend!r} not supported, only can be one of {list(BACKENDS)}"
+    m = BACKENDS[backend](path, cpu_threads, use_mkldnn, ir_optim, memory_optim)
+    m.vocabulary_path = model_vocabulary(path)
+    return m
+
+
+def export_onnx(path: Path, opset_version: int = 13) -> Path:
+    """把Paddle推理模型转换为同目录下的.onnx文件，返回文件路径"""
+    import paddle2onnx
+
+    path = Path(path)
+    save_file = path.with_suffix(".onnx")
+    paddle2onnx.export(
+        str(path.with_suffix(".pdmodel")), str(path.with_suffix(".pdiparams")), str(save_file), opset_version
+    )
+    return save_file
+
+
+def machine_info() -> dict:
+    """当前机器的CPU型号和核数，用于区分不同硬件的配置"""
+    cpu = ""
+    try:
+        with open("/proc/cpuinfo", encoding="utf-8") as f:
+            cpu = next((line.split(":", 1)[1].strip() for line in f if line.startswith("model name")), "")
+    except OSError:
+        pass
+    return {"cpu": cpu, "cores": os.cpu_count()}
+
+
+def save_profile(path: Path, profile: dict):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps({**profile, "machine": machine_info()}, indent=2, ensure_ascii=False), encoding="utf-8")
+
+
+def load_profile(path: Path) -> dict:
+    """读取调优配置，生成配置的机器与当前机器不一致时给出警告"""
+    profile = json.loads(Path(path).read_text(encoding="utf-8"))
+    machine = profile.get("machine")
+    if machine and machine != machine_info():
+        logger.warning(f"Profile {path} was tuned on {machine}, current machine is {machine_info()}")
+    return profile
+
+
+def profile_env(profile: dict) -> dict:
+    """配置转为服务环境变量"""
+    env = {}
+    for key, name in PROFILE_ENV.items():
+        if key not in profile:
+            continue
+        value = profile[key]
+        if isinstance(value, bool):
+            value = int(value)
+        elif isinstance(value, (list, tuple)):
+            value = ",".join(str(v) for v in value)
+        env[name] = str(value)
+    return env
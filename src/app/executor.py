@@ -0,0 +1,50 @@
+#! -*- coding: utf-8 -*-
+"""
+@Desc: 有界推理线程池，图片解码、预处理和推理都不占用事件循环
+"""
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+from src.app.metrics import EXECUTOR_PENDING
+
+
+class Overloaded(Exception):
+    """推理排队已满，需要客户端稍后重试"""
+
+
+class InferenceExecutor:
+    """有界推理线程池
+    max_workers: 并发推理线程数
+    max_pending: 排队+执行中的任务上限，超出后直接拒绝
+    """
+
+    def __init__(self, max_workers: int = 32, max_pending: int = 256):
+        assert max_workers > 0 and max_pending > 0, "max_workers and max_pending must be positive"
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="inference")
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def _release(self, _):
+        with self._lock:
+            self._pending -= 1
+            EXECUTOR_PENDING.set(self._pending)
+
+    async def run(self, fn: Callable, *args) -> Any:
+        """在线程池中执行fn，队列已满时抛出Overloaded"""
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise Overloaded(f"too many pending tasks: {self._pending}")
+            self._pending += 1
+            EXECUTOR_PENDING.set(self._pending)
+        # 以任务实际结束为准释放名额，客户端断开时也不会超发
+        fut = self._pool.submit(fn, *args)
+        fut.add_done_callback(self._release)
+        return await asyncio.wrap_future(fut)
@@ -0,0 +1,99 @@
+#! -*- coding: utf-8 -*-
+"""
+@Desc: Prometheus指标，多worker模式下通过PROMETHEUS_MULTIPROC_DIR汇总各进程数据
+"""
+import os
+import time
+import resource
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# 请求各阶段：读取请求体、图片解码、排队凑批、查表预处理、模型前向、CTC解码、束搜索、结果序列化
+STAGES = ("read", "decode", "queue", "preprocess", "forward", "ctc_decode", "beam_search", "serialize")
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+REQUEST_LATENCY = Histogram(
+    "captcha_request_seconds", "End-to-end request latency", ["path", "status"], buckets=LATENCY_BUCKETS
+)
+STAGE_LATENCY = Histogram("captcha_stage_seconds", "Latency of each request stage", ["stage"], buckets=LATENCY_BUCKETS)
+BATCH_SIZE = Histogram("captcha_batch_size", "Samples per model forward pass", buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+BUCKET_LATENCY = Histogram(
+    "captcha_bucket_forward_seconds", "Forward latency per padded batch-size bucket", ["bucket"], buckets=LATENCY_BUCKETS
+)
+BATCH_PADDING = Counter("captcha_batch_padding_total", "Padding rows added to reach a batch-size bucket")
+EXECUTOR_PENDING = Gauge(
+    "captcha_executor_pending", "Requests queued or running on the inference executor", multiprocess_mode="livesum"
+)
+BATCH_QUEUE = Gauge("captcha_batch_queue", "Groups waiting in the batch scheduler queue", multiprocess_mode="livesum")
+CACHE_REQUESTS = Counter("captcha_cache_requests_total", "Prediction cache lookups", ["result"])
+SINGLEFLIGHT_SHARED = Counter("captcha_singleflight_shared_total", "Requests served by an identical in-flight request")
+CASCADE_ROUTED = Counter("captcha_cascade_total", "Samples answered by each cascade stage", ["stage"])
+CASCADE_CONFIDENCE = Histogram(
+    "captcha_cascade_confidence",
+    "Average confidence of the simple-mode cascade stage",
+    buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.95, 0.98, 0.99),
+)
+SHADOW_PREDICTIONS = Counter("captcha_shadow_predictions_total", "Shadow model predictions", ["result"])
+ACCESS_LOG_DROPPED = Counter("captcha_access_log_dropped_total", "Access log records dropped on a full queue")
+PROCESS_RSS = Gauge(
+    "captcha_process_resident_memory_bytes", "Resident memory of the process", multiprocess_mode="liveall"
+)
+
+stage_seconds = {name: STAGE_LATENCY.labels(name) for name in STAGES}
+cache_hit = CACHE_REQUESTS.labels("hit")
+cache_miss = CACHE_REQUESTS.labels("miss")
+
+
+def rss_bytes() -> int:
+    """当前进程的常驻内存，优先读/proc，其他平台退化为峰值"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def render():
+    """导出指标文本，返回(内容, content-type)"""
+    PROCESS_RSS.set(rss_bytes())
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+class MetricsMiddleware:
+    """纯ASGI中间件，按路由统计请求耗时和状态码"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        st = time.perf_counter()
+        status = [500]
+
+        async def _send(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            # 按匹配到的路由模板打标签，未匹配的路径统一归为other，避免标签基数失控
+            route = scope.get("route")
+            path = getattr(route, "path", "other")
+            REQUEST_LATENCY.labels(path, str(status[0])).observe(time.perf_counter() - st)
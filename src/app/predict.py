@@ -1,35 +1,382 @@
 #! -*- coding: utf-8 -*-
+import math
+import bisect
+import time
+import threading
+from pathlib import Path
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, List, NamedTuple, Optional, Tuple
 
-import paddle
+import numpy as np
 from PIL import Image
 from loguru import logger
-from ppqi import InferenceModel
 
 from src import inference_path, vocabulary_path
-from src.helper.util import DataUtil
+from src.app import codec
+from src.app.metrics import (
+    BATCH_PADDING,
+    BUCKET_LATENCY,
+    CASCADE_CONFIDENCE,
+    CASCADE_ROUTED,
+    SHADOW_PREDICTIONS,
+    stage_seconds,
+)
+from src.app.registry import ModelRegistry
+from src.app.batcher import BatchScheduler
+from src.app.engine import Backend, create_model
+from src.app.settings import settings
+from src.helper.util import DataUtil, ImageUtil
 from src.helper.decoder import Decoder
+from src.helper.vocabulary import load_vocabulary
 
-# 加载模型
-inference_model_path = inference_path / "model"
-logger.info(f"Load model from {inference_model_path}...")
-model = InferenceModel(
-        modelpath=str(inference_model_path),
-        use_gpu=False,
-        use_mkldnn=True
-)
-model.eval()
+# 模型仓库，按版本存放导出的模型
+registry = ModelRegistry(settings.model_registry or inference_path)
+# 模型在服务启动时由load_model加载，warmup完成后才就绪；热更新时整体替换引用
+model = None
+model_version = None
+# 影子模型：与线上模型跑同一批输入，只记录识别结果不一致的样本，不影响返回
+shadow_model = None
+shadow_version = None
+_shadow_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shadow")
+# 影子模型最多积压的batch数，跟不上时直接跳过
+_shadow_slots = threading.BoundedSemaphore(4)
+_model_lock = threading.Lock()
+_ready = threading.Event()
+# 级联模式的简单模式模型，只识别数字和字母，置信度足够时不再经过全词表模型
+cascade_model = None
 # 解码器
 data_util = DataUtil(vocabulary_path)
 decoder = Decoder(data_util.get_vocabulary())
+simple_decoder = Decoder(load_vocabulary(vocabulary_path, simple_mode=True))
 
 
-def predict(img: Image.Image, r: int = 3):
-    batch_img = paddle.to_tensor([data_util.process_img(img)], dtype=paddle.float32)
-    outputs = paddle.to_tensor(model(batch_img))
-    outputs = paddle.nn.functional.softmax(outputs, axis=-1)
-    # 解码获取识别结果
-    label, ci_list = decoder.ctc_greedy_decoder(outputs[0], keep_ci=True)
+def _decoder(m: Backend, default: Decoder) -> Decoder:
+    """模型对应的解码器，裁剪过输出层的模型使用同目录下的词表"""
+    if m.vocabulary_path is None:
+        return default
+    return Decoder(load_vocabulary(m.vocabulary_path))
+
+
+def _create_model(path: Path) -> Backend:
+    logger.info(f"Load {settings.backend} model from {path}, cpu threads: {settings.cpu_threads}...")
+    return create_model(
+        path, settings.cpu_threads, settings.use_mkldnn, settings.ir_optim, settings.memory_optim, settings.backend
+    )
+
+
+def _forward(m: Backend, batch: np.ndarray):
+    m(batch, batch_size=len(batch))
+
+
+def _warmup_model(m: Backend, batch_sizes: List[int], submit: Callable[..., Future], rounds: int = 2):
+    """直接用模型空跑各batch大小，不经过级联分流，开启分档时只预热各档，超过单批上限的大小线上不会出现
+    submit: 把一次前向交给实际服务该模型的线程，oneDNN的primitive缓存按线程创建，在其他线程预热无效；
+    每次前向单独提交，预热期间线上的batch可以穿插执行
+    """
+    w, h = data_util.img_size
+    buf = np.zeros((settings.max_batch_size, 3, h, w), dtype=np.float32)
+    for n in buckets or sorted({min(n, settings.max_batch_size) for n in batch_sizes}):
+        for _ in range(rounds):
+            submit(_forward, m, buf[:n]).result()
+
+
+def load_model():
+    """加载上线版本的模型，重复调用直接返回，多worker模式下在fork前完成，子进程共享权重"""
+    global model, model_version, cascade_model
+    with _model_lock:
+        if model is None:
+            version = settings.model_version if settings.model_version is not None else registry.target()
+            model = _create_model(registry.model_path(version))
+            model_version = version
+        if cascade_model is None and settings.cascade_model:
+            cascade_model = _create_model(Path(settings.cascade_model))
+    return model
+
+
+def reload_model(version: Optional[str] = None, publish: bool = False) -> str:
+    """在当前线程加载新版本，在微批调度线程上预热，完成后原子替换，进行中的batch仍在旧模型上完成
+    version: 目标版本，为空时使用仓库的上线版本
+    publish: 切换成功后把版本写入仓库的CURRENT文件，开启仓库轮询的其他worker随之切换；加载失败时不写入
+    """
+    global model, model_version
+    with _model_lock:
+        version = registry.target() if version is None else version
+        if version != model_version:
+            m = _create_model(registry.model_path(version))
+            _warmup_model(m, settings.warmup_batch_sizes, batcher.call)
+            model = m
+            logger.info(f"Model switched from {model_version or '-'} to {version or '-'}")
+            model_version = version
+        if publish:
+            registry.set_current(version)
+    return version
+
+
+def set_shadow(version: Optional[str]):
+    """设置影子模型版本，为空时关闭影子模式"""
+    global shadow_model, shadow_version
+    if not version:
+        shadow_model = shadow_version = None
+        return
+    m = _create_model(registry.model_path(version))
+    # 影子模型只在影子线程上推理，也在该线程上预热
+    _warmup_model(m, settings.warmup_batch_sizes, _shadow_pool.submit)
+    shadow_model, shadow_version = m, version
+
+
+def _shadow_compare(m: Backend, version: str, batch_img: np.ndarray, labels: List[str], base: str):
+    try:
+        # 与线上模型一样补齐到分档大小，只出现预热过的输入形状
+        n = len(batch_img)
+        size = bucket_size(n)
+        outputs = m(_pad(batch_img, size), batch_size=size)[:n]
+        shadow_labels = _decoder(m, decoder).ctc_greedy_decode_logits(outputs)
+        for label, shadow_label in zip(labels, shadow_labels):
+            agree = label == shadow_label
+            SHADOW_PREDICTIONS.labels("agree" if agree else "disagree").inc()
+            if not agree:
+                logger.info(f"Shadow {version} disagrees with {base or '-'}: {label} -> {shadow_label}")
+    except Exception as e:
+        logger.exception(f"shadow model {version} failed: {e}")
+    finally:
+        _shadow_slots.release()
+
+
+def _submit_shadow(batch_img: np.ndarray, labels: List[str]):
+    m, version = shadow_model, shadow_version
+    if m is None or not _shadow_slots.acquire(blocking=False):
+        return
+    _shadow_pool.submit(_shadow_compare, m, version, batch_img.copy(), labels, model_version)
+
+
+def watch_registry(interval: float):
+    """后台轮询模型仓库，上线版本变化时热更新"""
+
+    def _run():
+        while True:
+            time.sleep(interval)
+            try:
+                reload_model()
+            except Exception as e:
+                logger.exception(f"reload model failed: {e}")
+
+    threading.Thread(target=_run, name="model-watcher", daemon=True).start()
+
+
+def is_ready() -> bool:
+    return _ready.is_set()
+
+
+class Job(NamedTuple):
+    """一次预测请求，rgb为uint8的HWC像素，beam_size大于1时额外做前缀束搜索返回nbest"""
+    rgb: np.ndarray
+    beam_size: int = 1
+    nbest: int = 1
+
+
+def _format(label: str, ci_list: list, r: int = 3):
     ci_new = [(c, round(ci, r)) for c, ci in ci_list]
     avg_ci = sum(ci for _, ci in ci_list) / len(ci_list) if len(ci_list) > 0 else 0
     ci_new.append((label, round(avg_ci, r)))
-    return label, ci_new
+    return {"predict_label": label, "ci": ci_new}
+
+
+# 每个线程一块预分配的batch缓冲区，预处理结果直接写入
+_local = threading.local()
+
+
+def _batch_buffer(n: int) -> np.ndarray:
+    buf = getattr(_local, "buffer", None)
+    if buf is None or len(buf) < n:
+        w, h = data_util.img_size
+        # 置零分配，补齐batch时多出的行始终是有限值
+        buf = _local.buffer = np.zeros((max(n, settings.max_batch_size), 3, h, w), dtype=np.float32)
+    return buf[:n]
+
+
+# batch大小档位：每批补齐到不小于样本数的最小一档，oneDNN只会见到这几种输入形状，最大一档即单批上限
+buckets = []
+if settings.batch_buckets:
+    buckets = sorted({b for b in settings.batch_buckets if 0 < b < settings.max_batch_size} | {settings.max_batch_size})
+
+
+def bucket_size(n: int) -> int:
+    i = bisect.bisect_left(buckets, n)
+    return buckets[i] if i < len(buckets) else n
+
+
+def _pad(batch_img: np.ndarray, size: int) -> np.ndarray:
+    """把batch补齐到size行，batch是当前线程缓冲区的前n行时直接取更长的切片，不做拷贝"""
+    n = len(batch_img)
+    if n == size:
+        return batch_img
+    buf = getattr(_local, "buffer", None)
+    if buf is not None and batch_img.base is buf and batch_img.ctypes.data == buf.ctypes.data and len(buf) >= size:
+        return buf[:size]
+    out = np.zeros((size, *batch_img.shape[1:]), dtype=batch_img.dtype)
+    out[:n] = batch_img
+    return out
+
+
+# 待束搜索的结果中暂存解码器、logits和请求参数的键
+_BEAM_KEY = "_beam"
+
+
+def _infer(m: Backend, dec: Decoder, batch_img: np.ndarray, jobs: List[Job], r: int = 3):
+    """一个模型整批前向并解码，返回结果和每条结果的平均置信度"""
+    n = len(jobs)
+    size = bucket_size(n)
+    inputs = _pad(batch_img, size)
+    BATCH_PADDING.inc(size - n)
+    # 补齐的行不参与解码
+    with stage_seconds["forward"].time(), BUCKET_LATENCY.labels(str(size)).time():
+        outputs = m(inputs, batch_size=size)[:n]
+    # 直接在logits上整批解码，省去全词表softmax
+    with stage_seconds["ctc_decode"].time():
+        decoded = dec.ctc_greedy_decode_logits(outputs, keep_ci=True)
+    results = [_format(label, ci_list, r) for label, ci_list in decoded]
+    avg_ci = [sum(ci for _, ci in ci_list) / len(ci_list) if ci_list else 0.0 for _, ci_list in decoded]
+    for job, output, res in zip(jobs, outputs, results):
+        if job.beam_size > 1:
+            # 束搜索不占用微批调度线程，只带出logits，由等待结果的线程调用finish_beam完成
+            res[_BEAM_KEY] = (dec, np.array(output), job)
+    return results, [label for label, _ in decoded], avg_ci
+
+
+def finish_beam(res: dict, r: int = 3) -> dict:
+    """对需要束搜索的结果做前缀束搜索，nbest单独返回，predict_label和ci仍为贪婪路径的结果，两者一致"""
+    beam = res.pop(_BEAM_KEY, None)
+    if beam is not None:
+        dec, logits, job = beam
+        with stage_seconds["beam_search"].time():
+            nbest = dec.ctc_prefix_beam_search(logits, beam_size=job.beam_size, nbest=job.nbest)
+        res["nbest"] = [(label, round(math.exp(score), r)) for label, score in nbest]
+    return res
+
+
+def predict_batch(jobs: List[Job], r: int = 3):
+    """批量预测，多张图片查表预处理到同一个[N,3,50,120]的batch做一次前向
+    开启级联时先用简单模式模型整批识别，平均置信度低于阈值的样本再交给全词表模型
+    """
+    with stage_seconds["preprocess"].time():
+        batch_img = data_util.process_batch([job.rgb for job in jobs], out=_batch_buffer(len(jobs)))
+    # 整批只读取一次模型引用，热更新不影响进行中的batch
+    m, cascade = model, cascade_model
+    results, index = [None] * len(jobs), list(range(len(jobs)))
+    if cascade is not None:
+        simple_results, _, avg_ci = _infer(cascade, _decoder(cascade, simple_decoder), batch_img, jobs, r)
+        index = []
+        for i, (res, ci) in enumerate(zip(simple_results, avg_ci)):
+            CASCADE_CONFIDENCE.observe(ci)
+            if ci >= settings.cascade_threshold:
+                results[i] = res
+            else:
+                index.append(i)
+        CASCADE_ROUTED.labels("simple").inc(len(jobs) - len(index))
+        CASCADE_ROUTED.labels("full").inc(len(index))
+        if not index:
+            return results
+        if len(index) < len(jobs):
+            batch_img, jobs = batch_img[index], [jobs[i] for i in index]
+    full_results, labels, _ = _infer(m, _decoder(m, decoder), batch_img, jobs, r)
+    if shadow_model is not None:
+        _submit_shadow(batch_img, labels)
+    for i, res in zip(index, full_results):
+        results[i] = res
+    return results
+
+
+# 动态微批调度：并发请求合并后一次前向
+batcher = BatchScheduler(predict_batch, settings.max_batch_size, settings.max_wait_ms / 1000)
+
+
+def predict(img: Image.Image, r: int = 3):
+    """单张图片预测，返回(label, ci)，经过微批调度线程推理
+    ci在调度线程中已保留3位小数，r只能进一步减少位数
+    """
+    load_model()
+    res = batcher.submit(Job(data_util.load_rgb(img))).result()
+    return res["predict_label"], [(c, round(ci, r)) for c, ci in res["ci"]]
+
+
+def warmup(batch_sizes: List[int], rounds: int = 2):
+    """用各典型batch大小空跑几轮，提前完成MKLDNN的kernel编译和primitive创建，之后标记为就绪
+    直接在微批调度线程上对线上模型和级联模型分别前向，不经过级联分流，两个模型都会预热，也不计入分流指标
+    """
+    load_model()
+    for name, m in (("model", model), ("cascade model", cascade_model)):
+        if m is None:
+            continue
+        st = time.perf_counter()
+        _warmup_model(m, batch_sizes, batcher.call, rounds)
+        logger.info(f"Warmup {name}: {(time.perf_counter() - st) * 1000:.1f}ms")
+    _ready.set()
+
+
+def predict_rgb(rgbs: List[np.ndarray], beam_size: int = 1, nbest: int = 1, channels: Optional[List[str]] = None):
+    """多张uint8的HWC像素交给微批调度器预处理和推理，阻塞等待结果
+    channels: 需要识别的颜色通道，各通道按颜色掩码处理后在同一个batch中推理，text表示原图
+    """
+    channels = channels or []
+    variants = max(1, len(channels))
+    jobs = []
+    for rgb in rgbs:
+        if not channels:
+            jobs.append(Job(rgb, beam_size, nbest))
+            continue
+        jobs.extend(Job(rgb if c == "text" else ImageUtil.mask_channel(rgb, c), beam_size, nbest) for c in channels)
+    # 按batch大小分组提交，同一张图片的各通道始终在同一组
+    step = max(1, settings.max_batch_size // variants) * variants
+    futures = []
+    for i in range(0, len(jobs), step):
+        futures.extend(batcher.submit_many(jobs[i: i + step]))
+    preds = [finish_beam(fut.result()) for fut in futures]
+    if not channels:
+        return preds
+    results = []
+    for i in range(0, len(preds), variants):
+        res = {"channels": dict(zip(channels, preds[i: i + variants]))}
+        # 只请求一个通道时结果同时放在顶层，与不区分通道的返回格式一致
+        if len(channels) == 1:
+            res.update(preds[i])
+        results.append(res)
+    return results
+
+
+def predict_bytes(contents: bytes, beam_size: int = 1, nbest: int = 1, channels: Optional[List[str]] = None):
+    """图片字节流（PNG等）解码后预测"""
+    with stage_seconds["decode"].time():
+        rgb = data_util.load_rgb(codec.decode_image(contents))
+    return predict_rgb([rgb], beam_size, nbest, channels)[0]
+
+
+def predict_base64(data: bytes, beam_size: int = 1, nbest: int = 1, channels: Optional[List[str]] = None):
+    """base64编码的图片，在线程池中解码后预测"""
+    return predict_bytes(codec.decode_base64(data), beam_size, nbest, channels)
+
+
+def predict_ndarray(body: bytes, beam_size: int = 1, nbest: int = 1, channels: Optional[List[str]] = None):
+    """打包的原始像素批量预测，跳过图片解码"""
+    with stage_seconds["decode"].time():
+        pixels = codec.unpack_ndarray(body)
+    w, h = data_util.img_size
+    if pixels.shape[1:3] != (h, w):
+        raise codec.DecodeError(f"image size must be {h}x{w}, got {pixels.shape[1]}x{pixels.shape[2]}")
+    return {"predictions": predict_rgb([rgb[:, :, :3] for rgb in pixels], beam_size, nbest, channels)}
+
+
+def predict_files(files: List[Tuple[str, bytes]], beam_size: int = 1, nbest: int = 1, channels: Optional[List[str]] = None):
+    """多张图片批量预测，返回每张图片一条结果，单张图片解码失败不影响其余图片"""
+    rgbs, results = [], []
+    for filename, contents in files:
+        try:
+            with stage_seconds["decode"].time():
+                rgbs.append(data_util.load_rgb(codec.decode_image(contents)))
+            results.append({"filename": filename, "code": 0})
+        except codec.DecodeError as e:
+            results.append({"filename": filename, "code": 400, "error": str(e)})
+    preds = iter(predict_rgb(rgbs, beam_size, nbest, channels))
+    for res in results:
+        if res["code"] == 0:
+            res.update(next(preds))
+    return results
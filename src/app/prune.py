@@ -0,0 +1,71 @@
+#! -*- coding: utf-8 -*-
+"""
+@Desc: 按线上实际出现的字符集裁剪推理模型的输出层和词表，缩小最后一层matmul、softmax和解码的计算量
+"""
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+from loguru import logger
+
+from src.app.engine import VOCABULARY_FILE
+from src.helper.vocabulary import Vocabulary
+
+
+def _output_layer(block, fetch_name: str):
+    """从输出变量往回找到最后一层Linear：matmul_v2乘权重，elementwise_add加偏置
+    跳过导出时追加的恒等scale，返回权重名、偏置名、偏置相加的输入和输出变量名
+    """
+    producers = {name: op for op in block.ops for name in op.output_arg_names}
+    op = producers[fetch_name]
+    while op.type == "scale":
+        assert op.attr("scale") == 1 and op.attr("bias") == 0, "only identity scale is allowed after the output layer"
+        op = producers[op.input("X")[0]]
+    assert op.type == "elementwise_add", f"unexpected output op {op.type}"
+    matmul = producers[op.input("X")[0]]
+    assert matmul.type == "matmul_v2" and not matmul.attr("trans_y"), f"unexpected output op {matmul.type}"
+    return matmul.input("Y")[0], op.input("Y")[0], [op.input("X")[0], op.output("Out")[0]]
+
+
+def prune_vocabulary(path: Path, save_path: Path, chars: Iterable[str], vocabulary: Vocabulary) -> Vocabulary:
+    """只保留chars中的字符和空白类别，裁剪后的模型和词表写到save_path所在目录
+    path、save_path: 模型路径前缀，不含.pdmodel后缀
+    vocabulary: 原模型的词表，词表外的字符忽略
+    返回裁剪后的词表，字符顺序与原词表一致，空白类别仍在最后
+    """
+    import paddle
+
+    path, save_path = Path(path), Path(save_path)
+    chars = {c for c in chars if c.strip()}
+    missing = sorted(c for c in chars if c not in vocabulary)
+    if missing:
+        logger.warning(f"{len(missing)} characters not in vocabulary are ignored: {''.join(missing[:50])}")
+    keep = np.array(sorted(vocabulary.to_dict()[c] for c in chars if c in vocabulary) + [len(vocabulary)])
+    assert len(keep) > 1, "no character left after pruning"
+    pruned = Vocabulary([vocabulary[i] for i in keep[:-1]])
+
+    paddle.enable_static()
+    try:
+        exe = paddle.static.Executor(paddle.CPUPlace())
+        scope = paddle.static.Scope()
+        with paddle.static.scope_guard(scope):
+            program, feed_names, fetch_vars = paddle.static.load_inference_model(str(path), exe)
+            block = program.global_block()
+            weight, bias, outputs = _output_layer(block, fetch_vars[0].name)
+            for name, axis in ((weight, 1), (bias, 0)):
+                tensor = scope.find_var(name).get_tensor()
+                tensor.set(np.ascontiguousarray(np.take(np.array(tensor), keep, axis=axis)), paddle.CPUPlace())
+                shape = list(block.var(name).shape)
+                shape[axis] = len(keep)
+                block.var(name).desc.set_shape(shape)
+            for name in outputs:
+                block.var(name).desc.set_shape([*block.var(name).shape[:-1], len(keep)])
+            # 直接以偏置相加的结果作为输出，保存时会重新追加恒等scale
+            paddle.static.save_inference_model(
+                str(save_path), [block.var(name) for name in feed_names], [block.var(outputs[-1])], exe, program=program
+            )
+    finally:
+        paddle.disable_static()
+    (save_path.parent / VOCABULARY_FILE).write_text("\n".join(pruned), encoding="utf-8")
+    logger.info(f"Pruned output classes from {len(vocabulary) + 1} to {len(keep)}, saved to {save_path}")
+    return pruned
@@ -0,0 +1,159 @@
+#! -*- coding: utf-8 -*-
+"""
+@Desc: 推理模型的训练后静态量化（INT8），用标注数据的测试集校准，并对比量化前后的精度、速度和模型大小
+"""
+import importlib.util
+import shutil
+import sys
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+from loguru import logger
+
+from src import proj_path
+from src.app.engine import VOCABULARY_FILE, create_model, model_vocabulary, Backend
+from src.app.tune import measure_latency, synthetic_batch, format_result
+
+# 参与量化的算子，LSTM等其余算子保持FP32
+QUANTIZABLE_OP_TYPE = ["conv2d", "depthwise_conv2d", "mul", "matmul", "matmul_v2"]
+
+
+def _train_module(name: str):
+    """加载训练代码中的模块，目录名src/train(deprecated)不能直接import"""
+    module_name = f"src.train_deprecated.{name}"
+    if module_name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(module_name, proj_path / "src/train(deprecated)" / f"{name}.py")
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        sys.modules[module_name] = module
+    return sys.modules[module_name]
+
+
+def load_samples(
+    dataset_dirs: List[str],
+    vocabulary_path: Path,
+    channel: str = "text",
+    data_type: str = "color",
+    max_len: int = 6,
+    limit: int = 0,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """读取标注数据的测试集，返回预处理后的[N,3,H,W]图片和[N,max_len]标签
+    limit: 最多读取的样本数，0为不限
+    """
+    dataset = _train_module("dataset").CaptchaDataset(
+        dataset_dirs=dataset_dirs,
+        vocabulary_path=str(vocabulary_path),
+        mode="test",
+        channel=channel,
+        data_type=data_type,
+        max_len=max_len,
+    )
+    n = len(dataset) if limit <= 0 else min(limit, len(dataset))
+    assert n > 0, f"no test samples found in {dataset_dirs}"
+    images, labels = zip(*(dataset[i] for i in range(n)))
+    return np.stack(images), np.stack(labels)
+
+
+def quantize(
+    model_path: Path,
+    save_path: Path,
+    images: np.ndarray,
+    batch_size: int = 16,
+    batch_nums: int = 10,
+    algo: str = "KL",
+):
+    """训练后静态量化，用images统计各层激活的取值范围，量化模型写到save_path
+    model_path、save_path: 模型路径前缀，不含.pdmodel后缀，save_path可以直接作为仓库中的一个版本
+    algo: 激活值量化参数的计算方法，KL、hist、avg、mse、abs_max等
+    保存为quantize_linear/dequantize_linear格式，权重按INT8存储，Paddle后端开启mkldnn时用INT8算子推理
+    """
+    import paddle
+    from paddle.static.quantization import PostTrainingQuantization
+
+    model_path, save_path = Path(model_path), Path(save_path)
+
+    class _Calibration(paddle.io.Dataset):
+        def __init__(self, feed_name: str):
+            self.feed_name = feed_name
+
+        def __len__(self):
+            return len(images)
+
+        def __getitem__(self, idx):
+            return {self.feed_name: images[idx]}
+
+    paddle.enable_static()
+    try:
+        exe = paddle.static.Executor(paddle.CPUPlace())
+        _, feed_names, _ = paddle.static.load_inference_model(str(model_path), exe)
+        ptq = PostTrainingQuantization(
+            executor=exe,
+            model_dir=str(model_path.parent),
+            model_filename=model_path.with_suffix(".pdmodel").name,
+            params_filename=model_path.with_suffix(".pdiparams").name,
+            data_loader=paddle.io.DataLoader(_Calibration(feed_names[0]), batch_size=batch_size, return_list=True),
+            batch_size=batch_size,
+            batch_nums=batch_nums,
+            algo=algo,
+            quantizable_op_type=QUANTIZABLE_OP_TYPE,
+            onnx_format=True,
+        )
+        ptq.quantize()
+        ptq.save_quantized_model(
+            str(save_path.parent),
+            model_filename=save_path.with_suffix(".pdmodel").name,
+            params_filename=save_path.with_suffix(".pdiparams").name,
+        )
+    finally:
+        paddle.disable_static()
+    # 裁剪过输出层的模型带上自己的词表
+    vocab = model_vocabulary(model_path)
+    if vocab is not None:
+        shutil.copyfile(vocab, save_path.parent / VOCABULARY_FILE)
+    logger.info(f"Quantized model saved to {save_path}")
+    return save_path
+
+
+def evaluate(m: Backend, images: np.ndarray, labels: np.ndarray, vocabulary, batch_size: int = 32) -> dict:
+    """用训练时的SampleAccuracy、WordsErrorRate评估模型"""
+    metric = _train_module("metric")
+    acc, wer = metric.SampleAccuracy(vocabulary), metric.WordsErrorRate(vocabulary)
+    for i in range(0, len(images), batch_size):
+        logits = m(images[i: i + batch_size])
+        acc.update(logits, labels[i: i + batch_size])
+        wer.update(logits, labels[i: i + batch_size])
+    return {"sample_acc": round(acc.accumulate(), 4), "words_error_rate": round(wer.accumulate(), 4)}
+
+
+def _model_size(path: Path) -> int:
+    return sum(path.with_suffix(suffix).stat().st_size for suffix in (".pdmodel", ".pdiparams"))
+
+
+def compare(
+    fp32_path: Path,
+    int8_path: Path,
+    images: np.ndarray,
+    labels: np.ndarray,
+    vocabulary,
+    batch_size: int = 16,
+    cpu_threads: int = 1,
+    seconds: float = 1.0,
+) -> dict:
+    """对比FP32和INT8模型的精度、每批延迟和模型大小，delta为INT8减FP32"""
+    report = {}
+    batch = synthetic_batch(batch_size)
+    for name, path in (("fp32", Path(fp32_path)), ("int8", Path(int8_path))):
+        m = create_model(path, cpu_threads)
+        latency = measure_latency(m, batch, seconds)
+        report[name] = {
+            **evaluate(m, images, labels, vocabulary, batch_size),
+            "p50_ms": round(float(np.percentile(latency, 50)), 3),
+            "size_mb": round(_model_size(path) / (1 << 20), 3),
+        }
+        logger.info(f"{name}: {format_result(report[name])}")
+        # 先释放FP32模型再加载INT8模型
+        del m
+    report["delta"] = {k: round(report["int8"][k] - report["fp32"][k], 4) for k in report["fp32"]}
+    logger.info(f"delta: {format_result(report['delta'])}")
+    return report
@@ -0,0 +1,77 @@
+#! -*- coding: utf-8 -*-
+"""
+@Desc: 模型仓库，按版本目录存放导出的推理模型
+
+目录结构：
+    <root>/<version>/model.pdmodel、model.pdiparams  各版本导出的模型，ONNX后端使用同目录的model.onnx
+    <root>/CURRENT                                   可选，指定当前上线的版本，缺省为最新版本
+    <root>/model.pdmodel、model.pdiparams            未分版本的旧模型，仓库中没有任何版本时使用
+"""
+import os
+import re
+from pathlib import Path
+from typing import List, Optional
+
+# 未分版本的旧模型
+LEGACY_VERSION = ""
+
+
+class ModelNotFound(ValueError):
+    """仓库中没有指定的版本或模型文件"""
+
+
+def _has_model(path: Path) -> bool:
+    return path.with_suffix(".pdmodel").is_file() or path.with_suffix(".onnx").is_file()
+
+
+def _version_key(version: str):
+    # 自然排序，v10排在v9之后
+    return [int(s) if s.isdigit() else s for s in re.split(r"(\d+)", version)]
+
+
+class ModelRegistry:
+    """模型仓库
+    root: 仓库目录
+    """
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+
+    @property
+    def current_file(self) -> Path:
+        return self.root / "CURRENT"
+
+    def versions(self) -> List[str]:
+        """所有可用版本，按版本号从旧到新排序"""
+        if not self.root.is_dir():
+            return []
+        names = [p.name for p in self.root.iterdir() if _has_model(p / "model")]
+        return sorted(names, key=_version_key)
+
+    def target(self) -> str:
+        """应当上线的版本：CURRENT指定的版本，否则为最新版本，仓库为空时为旧模型"""
+        if self.current_file.is_file():
+            version = self.current_file.read_text(encoding="utf-8").strip()
+            if version:
+                return version
+        versions = self.versions()
+        return versions[-1] if versions else LEGACY_VERSION
+
+    def set_current(self, version: Optional[str]):
+        """指定上线版本，为空时恢复为最新版本；先写临时文件再改名，其他进程不会读到半个文件"""
+        if not version:
+            self.current_file.unlink(missing_ok=True)
+            return
+        tmp = self.current_file.with_suffix(f".{os.getpid()}.tmp")
+        tmp.write_text(version, encoding="utf-8")
+        os.replace(tmp, self.current_file)
+
+    def model_path(self, version: str) -> Path:
+        """版本对应的模型路径前缀，不含.pdmodel后缀"""
+        # version可能来自管理接口的请求参数，只接受仓库中已有的版本名
+        if version and version not in self.versions():
+            raise ModelNotFound(f"model version {version!r} not found in {self.root}")
+        path = self.root / version / "model" if version else self.root / "model"
+        if not _has_model(path):
+            raise ModelNotFound(f"model not found in {path.parent}")
+        return path
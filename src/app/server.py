@@ -0,0 +1,94 @@
+#! -*- coding: utf-8 -*-
+"""
+@Desc: 多进程推理服务，多个worker共享同一个监听端口
+"""
+import os
+import signal
+import shutil
+import tempfile
+from typing import Callable
+
+import uvicorn
+from loguru import logger
+
+from src.app.settings import WORKER_ID_ENV, settings
+
+
+def _spawn(config: uvicorn.Config, sock, index: int, on_exit: Callable[[], None]) -> int:
+    """fork一个worker，index为worker编号，重启的worker沿用原编号
+    on_exit: worker退出前调用，os._exit不会执行atexit，队列中的日志在这里写出
+    """
+    pid = os.fork()
+    if pid == 0:
+        # 子进程：恢复默认信号处理，交由uvicorn接管
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        os.environ[WORKER_ID_ENV] = str(index)
+        try:
+            uvicorn.Server(config).run(sockets=[sock])
+        finally:
+            try:
+                on_exit()
+            finally:
+                os._exit(0)
+    return pid
+
+
+def serve(host: str, port: int, workers: int = 1):
+    """启动服务
+    workers: worker进程数，大于1时先在主进程加载模型再fork，权重以写时复制方式共享
+    """
+    metrics_dir = None
+    if workers > 1 and "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        # 各worker的指标写入共享目录，/metrics由任意worker汇总输出，必须在导入prometheus_client前设置
+        metrics_dir = os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="captcha-metrics-")
+    from src.app import app as m_app, predict
+    from prometheus_client import multiprocess
+
+    config = uvicorn.Config(m_app.app, host=host, port=port)
+    if workers <= 1:
+        if settings.backend == "paddle":
+            # paddle导入时在C层注册SIGTERM等信号处理，直接终止进程；在uvicorn之前导入，信号由uvicorn接管并正常关闭
+            import paddle  # noqa: F401
+        uvicorn.Server(config).run()
+        return
+
+    # 模型在fork前加载，子进程以写时复制方式共享权重，各worker启动后再各自预热
+    predict.load_model()
+    # 主进程不处理请求，导入时创建的live模式gauge文件（如内存占用）删掉，/metrics中只出现各worker
+    multiprocess.mark_process_dead(os.getpid())
+    sock = config.bind_socket()
+    children = {_spawn(config, sock, i, m_app.flush_logs): i for i in range(workers)}
+    logger.info(f"Started {workers} workers: {sorted(children)}")
+
+    stopping = False
+
+    def _stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for child in children:
+            try:
+                os.kill(child, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, _stop)
+    signal.signal(signal.SIGTERM, _stop)
+
+    # 监控子进程，异常退出的worker自动拉起
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        index = children.pop(pid, None)
+        multiprocess.mark_process_dead(pid)
+        if not stopping and index is not None:
+            logger.warning(f"Worker {pid} exited with status {status}, restarting...")
+            children[_spawn(config, sock, index, m_app.flush_logs)] = index
+    sock.close()
+    if metrics_dir is not None:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+    logger.info("All workers stopped")
@@ -0,0 +1,76 @@
+#! -*- coding: utf-8 -*-
+"""
+@Desc: 服务配置，统一从环境变量读取，多进程worker可直接继承
+"""
+import os
+
+# 多worker模式下由server在fork后设置的worker编号，不在Settings中读取，fork前导入时尚未设置
+WORKER_ID_ENV = "CAPTCHA_WORKER_ID"
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def _env_float(name: str, default: float) -> float:
+    value = os.getenv(name)
+    return float(value) if value else default
+
+
+class Settings:
+    """服务配置"""
+
+    def __init__(self):
+        # 每个worker进程的CPU数学库线程数
+        self.cpu_threads = _env_int("CAPTCHA_CPU_THREADS", 1)
+        # 推理后端：paddle或onnx
+        self.backend = os.getenv("CAPTCHA_BACKEND") or "paddle"
+        # 推理引擎选项：MKLDNN加速、计算图优化、中间结果内存复用
+        self.use_mkldnn = bool(_env_int("CAPTCHA_USE_MKLDNN", 1))
+        self.ir_optim = bool(_env_int("CAPTCHA_IR_OPTIM", 1))
+        self.memory_optim = bool(_env_int("CAPTCHA_MEMORY_OPTIM", 0))
+        # 动态微批：单批最大样本数、凑批最长等待时间
+        self.max_batch_size = _env_int("CAPTCHA_MAX_BATCH_SIZE", 16)
+        self.max_wait_ms = _env_float("CAPTCHA_MAX_WAIT_MS", 5.0)
+        # 模型仓库目录（默认为项目的inference目录）、固定上线版本、仓库轮询间隔（秒，0为关闭）、影子模型版本
+        self.model_registry = os.getenv("CAPTCHA_MODEL_REGISTRY") or None
+        self.model_version = os.getenv("CAPTCHA_MODEL_VERSION")
+        self.model_watch_interval = _env_float("CAPTCHA_MODEL_WATCH_INTERVAL", 0)
+        self.shadow_version = os.getenv("CAPTCHA_SHADOW_VERSION") or None
+        # 级联模式：简单模式模型路径（不含.pdmodel后缀，为空则关闭）、转交全词表模型的平均置信度阈值
+        self.cascade_model = os.getenv("CAPTCHA_CASCADE_MODEL") or None
+        self.cascade_threshold = _env_float("CAPTCHA_CASCADE_THRESHOLD", 0.9)
+        # 管理接口的访问令牌，为空时管理接口关闭
+        self.admin_token = os.getenv("CAPTCHA_ADMIN_TOKEN") or None
+        # batch大小档位，逗号分隔，每批补齐到其中一档，为空则不补齐
+        self.batch_buckets = [int(n) for n in os.getenv("CAPTCHA_BATCH_BUCKETS", "1,4,8,16,32").split(",") if n.strip()]
+        # 未开启分档时启动预热的batch大小，逗号分隔，为空则不预热
+        self.warmup_batch_sizes = [
+            int(n) for n in os.getenv("CAPTCHA_WARMUP_BATCH_SIZES", "1,2,4,8,16").split(",") if n.strip()
+        ]
+        # 有界推理线程池：并发线程数、排队上限、拒绝时建议的重试间隔（秒）
+        self.max_workers = _env_int("CAPTCHA_MAX_WORKERS", 32)
+        self.max_pending = _env_int("CAPTCHA_MAX_PENDING", 256)
+        self.retry_after = _env_int("CAPTCHA_RETRY_AFTER", 1)
+        # 每个WebSocket连接同时处理的最大请求数
+        self.ws_max_inflight = _env_int("CAPTCHA_WS_MAX_INFLIGHT", 64)
+        # 批量接口单次上传的最大文件数，单张图片（含压缩包成员解压后）的最大字节数，超出的图片不读取
+        self.max_upload_files = _env_int("CAPTCHA_MAX_UPLOAD_FILES", 10000)
+        self.max_member_size = _env_int("CAPTCHA_MAX_MEMBER_SIZE", 10 << 20)
+        # 预测结果缓存：内存条目数（0为关闭）、过期时间（秒）、可选磁盘缓存路径
+        self.cache_size = _env_int("CAPTCHA_CACHE_SIZE", 10000)
+        self.cache_ttl = _env_float("CAPTCHA_CACHE_TTL", 3600)
+        self.cache_path = os.getenv("CAPTCHA_CACHE_PATH") or None
+        # 慢请求阈值（毫秒），慢请求总是写入访问日志和抓包文件
+        self.slow_ms = _env_float("CAPTCHA_SLOW_MS", 500)
+        # 访问日志：文件路径、正常请求采样比例、是否记录预测结果
+        self.access_log_path = os.getenv("CAPTCHA_ACCESS_LOG_PATH") or "logs/access.log"
+        self.access_log_sample = _env_float("CAPTCHA_ACCESS_LOG_SAMPLE", 1.0)
+        self.access_log_predictions = bool(_env_int("CAPTCHA_ACCESS_LOG_PREDICTIONS", 1))
+        # 请求抓包：文件路径（为空则关闭）、正常请求采样比例
+        self.capture_path = os.getenv("CAPTCHA_CAPTURE_PATH") or None
+        self.capture_sample = _env_float("CAPTCHA_CAPTURE_SAMPLE", 0.01)
+
+
+settings = Settings()
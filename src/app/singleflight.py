@@ -0,0 +1,32 @@
+#! -*- coding: utf-8 -*-
+"""
+@Desc: 合并相同键的并发请求，同一时刻只做一次计算
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict
+
+from src.app.metrics import SINGLEFLIGHT_SHARED
+
+
+class SingleFlight:
+    """相同键的并发调用共享同一个进行中的计算"""
+
+    def __init__(self):
+        self.shared = 0
+        self._calls: Dict[str, asyncio.Future] = {}
+
+    @property
+    def inflight(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key: str, fn: Callable[..., Awaitable], *args) -> Any:
+        task = self._calls.get(key)
+        if task is None:
+            # 计算作为独立task运行，发起者断开时其余等待者不受影响
+            task = asyncio.ensure_future(fn(*args))
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        else:
+            self.shared += 1
+            SINGLEFLIGHT_SHARED.inc()
+        return await asyncio.shield(task)
@@ -0,0 +1,171 @@
+#! -*- coding: utf-8 -*-
+"""
+@Desc: 推理引擎调优，用合成输入在本机上测试线程数、batch大小和引擎选项，输出最优配置
+"""
+import os
+import time
+import itertools
+from pathlib import Path
+from typing import List
+
+import numpy as np
+from loguru import logger
+
+from src.app.engine import Backend, create_model, save_profile
+from src.helper.decoder import Decoder
+
+INPUT_SHAPE = (3, 50, 120)
+
+
+def synthetic_batch(batch_size: int, input_shape=INPUT_SHAPE) -> np.ndarray:
+    """固定随机种子的测速输入"""
+    return np.random.default_rng(0).standard_normal((batch_size, *input_shape), dtype=np.float32)
+
+
+def measure_latency(m: Backend, batch: np.ndarray, seconds: float = 1.0, warmup: int = 3):
+    """返回每批延迟（毫秒）"""
+    for _ in range(warmup):
+        m(batch, batch_size=len(batch))
+    latency = []
+    st = time.perf_counter()
+    while time.perf_counter() - st < seconds or len(latency) < 3:
+        t = time.perf_counter()
+        m(batch, batch_size=len(batch))
+        latency.append(time.perf_counter() - t)
+    return np.array(latency) * 1000
+
+
+def benchmark(
+    model_path: Path,
+    batch_size: int,
+    cpu_threads: int = 1,
+    use_mkldnn: bool = True,
+    ir_optim: bool = True,
+    memory_optim: bool = False,
+    backend: str = "paddle",
+    seconds: float = 1.0,
+):
+    """单个配置的测速，返回每批延迟的分位数和吞吐"""
+    m = create_model(model_path, cpu_threads, use_mkldnn, ir_optim, memory_optim, backend)
+    latency = measure_latency(m, synthetic_batch(batch_size), seconds)
+    return {
+        "backend": backend,
+        "batch_size": batch_size,
+        "cpu_threads": cpu_threads,
+        "use_mkldnn": use_mkldnn,
+        "ir_optim": ir_optim,
+        "memory_optim": memory_optim,
+        "p50_ms": round(float(np.percentile(latency, 50)), 3),
+        "p99_ms": round(float(np.percentile(latency, 99)), 3),
+        "throughput": round(batch_size * 1000 / float(latency.mean()), 2),
+    }
+
+
+def format_result(res: dict) -> str:
+    """测速结果格式化为一行日志"""
+    return ", ".join(f"{k}: {v}" for k, v in res.items())
+
+
+def tune(
+    model_path: Path,
+    profile_path: Path,
+    threads: List[int] = None,
+    batch_sizes: List[int] = None,
+    max_latency_ms: float = 100,
+    seconds: float = 1.0,
+    backend: str = "paddle",
+):
+    """分阶段搜索：先在固定线程数和batch大小下比较引擎选项，再搜索线程数，最后在延迟上限内选最大吞吐的batch大小
+    线程数按整机吞吐比较：每个worker占用cpu_threads个核，整机可以运行 核数 // cpu_threads 个worker
+    """
+    cores = os.cpu_count() or 1
+    threads = threads or sorted({t for t in (1, 2, 4, 8, 16) if t <= cores})
+    batch_sizes = batch_sizes or [1, 4, 8, 16, 32]
+    results = []
+
+    def _run(**kwargs):
+        res = benchmark(model_path, backend=backend, seconds=seconds, **kwargs)
+        results.append(res)
+        logger.info(format_result(res))
+        return res
+
+    # 1. 引擎选项，ONNX Runtime只有图优化开关
+    base_batch = batch_sizes[len(batch_sizes) // 2]
+    grid = itertools.product((True, False), (True, False), (False, True))
+    if backend == "onnx":
+        grid = [(False, True, False), (False, False, False)]
+    best = max(
+        (
+            _run(batch_size=base_batch, cpu_threads=threads[0], use_mkldnn=mkldnn, ir_optim=ir, memory_optim=mem)
+            for mkldnn, ir, mem in grid
+        ),
+        key=lambda res: res["throughput"],
+    )
+    options = {k: best[k] for k in ("use_mkldnn", "ir_optim", "memory_optim")}
+
+    # 2. 线程数，按整机吞吐比较
+    best = max(
+        (_run(batch_size=base_batch, cpu_threads=t, **options) for t in threads),
+        key=lambda res: res["throughput"] * max(1, cores // res["cpu_threads"]),
+    )
+    cpu_threads = best["cpu_threads"]
+
+    # 3. batch大小，p99延迟不超过上限的配置中吞吐最大的，都超出时取最小的batch
+    runs = [_run(batch_size=bs, cpu_threads=cpu_threads, **options) for bs in sorted(batch_sizes)]
+    within = [res for res in runs if res["p99_ms"] <= max_latency_ms] or runs[:1]
+    best = max(within, key=lambda res: res["throughput"])
+
+    max_batch_size = best["batch_size"]
+    profile = {
+        "backend": backend,
+        "cpu_threads": cpu_threads,
+        "workers": max(1, cores // cpu_threads),
+        "max_batch_size": max_batch_size,
+        "batch_buckets": [bs for bs in sorted(batch_sizes) if bs <= max_batch_size],
+        **options,
+        "best": best,
+        "results": results,
+    }
+    save_profile(profile_path, profile)
+    logger.info(f"Best: {format_result(best)}, workers: {profile['workers']}, profile saved to {profile_path}")
+    return profile
+
+
+def compare_backends(
+    model_path: Path,
+    decoder: Decoder,
+    batch_sizes: List[int] = None,
+    cpu_threads: int = 1,
+    seconds: float = 1.0,
+    images: np.ndarray = None,
+):
+    """对比Paddle和ONNX Runtime后端：同一批输入的logits误差、解码结果一致率，以及各batch大小的速度
+    images: 可选的真实样本，[N,3,H,W]预处理后的float32，缺省为合成输入
+    """
+    backends = {name: create_model(model_path, cpu_threads, backend=name) for name in ("paddle", "onnx")}
+    inputs = images if images is not None else synthetic_batch(32)
+    outputs = {name: m(inputs, batch_size=len(inputs)) for name, m in backends.items()}
+    paddle_out, onnx_out = outputs["paddle"], outputs["onnx"]
+    labels = {name: decoder.ctc_greedy_decode_logits(out) for name, out in outputs.items()}
+    report = {
+        "samples": len(inputs),
+        "max_abs_diff": float(np.abs(paddle_out - onnx_out).max()),
+        "argmax_agreement": float((paddle_out.argmax(-1) == onnx_out.argmax(-1)).mean()),
+        "label_agreement": float(np.mean([a == b for a, b in zip(labels["paddle"], labels["onnx"])])),
+        "speed": [],
+    }
+    logger.info(f"Parity: {format_result({k: v for k, v in report.items() if k != 'speed'})}")
+    for bs in batch_sizes or [1, 4, 8, 16, 32]:
+        batch = synthetic_batch(bs)
+        for name, m in backends.items():
+            latency = measure_latency(m, batch, seconds)
+            res = {
+                "backend": name,
+                "batch_size": bs,
+                "p50_ms": round(float(np.percentile(latency, 50)), 3),
+                "p99_ms": round(float(np.percentile(latency, 99)), 3),
+                "throughput": round(bs * 1000 / float(latency.mean()), 2),
+            }
+            report["speed"].append(res)
+            logger.info(format_result(res))
+    return report
@@ -1,49 +1,150 @@
 #! -*- coding: utf-8 -*-
 
+import math
+from collections import defaultdict
+
 import numpy as np
-from itertools import groupby
+
+from src.helper.vocabulary import Vocabulary
+
+
+def _log_add(a: float, b: float) -> float:
+    """log(exp(a) + exp(b))"""
+    if a == -math.inf:
+        return b
+    if b == -math.inf:
+        return a
+    if a < b:
+        a, b = b, a
+    return a + math.log1p(math.exp(b - a))
 
 
 class Decoder:
     """解码器"""
 
-    def __init__(self, vocabulary: list):
+    def __init__(self, vocabulary: Vocabulary):
+        if not isinstance(vocabulary, Vocabulary):
+            vocabulary = Vocabulary(vocabulary)
         self.vocabulary = vocabulary
         self.blank_index = len(self.vocabulary)
+        # 索引到字符的查找表，空白索引对应空串
+        self._chars = vocabulary.id2char
 
     def ctc_greedy_decoder(self, probs_seq, keep_ci=False):
         """CTC贪婪（最佳路径）解码器。
         由最可能的令牌组成的路径被进一步后处理
         删除连续的重复和所有的空白。
         """
+        return self.ctc_greedy_decode_batch(np.asarray(probs_seq)[None], keep_ci=keep_ci)[0]
+
+    def _check(self, seq) -> np.ndarray:
+        seq = np.asarray(seq)
         # 尺寸验证
-        for probs in probs_seq:
-            if not len(probs) == len(self.vocabulary) + 1:
-                raise ValueError("probs_seq 尺寸与词汇不匹配")
+        if seq.ndim != 3 or seq.shape[-1] != len(self.vocabulary) + 1:
+            raise ValueError("probs_seq 尺寸与词汇不匹配")
+        return seq
+
+    def ctc_greedy_decode_batch(self, probs: np.ndarray, keep_ci=False):
+        """批量CTC贪婪解码，输入[N,T,C]的概率，一次返回N个结果。
+        argmax、去重、去空白和每个字符的置信度平均全部用数组运算完成。
+        """
+        probs = self._check(probs)
         # argmax以获得每个时间步长的最佳指标
-        max_index_list = np.argmax(probs_seq, -1)
-        # 删除连续的重复索引
-        index_list = [index_group[0] for index_group in groupby(max_index_list)]
-        # 删除空白索引
-        index_list = [index for index in index_list if index != self.blank_index]
-        # 将索引列表转换为字符串
-        label = ''.join([self.vocabulary[index] for index in index_list])
-        if keep_ci:
-            arr = [[]]
-            prev = max_index_list[0]
-            keys = [prev]
-            ci = [round(probs_seq[i, j].numpy().item(), 3) for i, j in enumerate(max_index_list)]
-            for k, v in zip(max_index_list, ci):
-                if k == prev:
-                    arr[-1].append(v)
-                else:
-                    prev = k
-                    keys.append(k)
-                    arr.append([v])
-            ci = [(self.vocabulary[k], np.mean(vli)) for k, vli in zip(keys, arr) if k != self.blank_index]
-            return label, ci
-        return label
+        index = np.argmax(probs, -1)
+        ci = np.take_along_axis(probs, index[..., None], -1)[..., 0] if keep_ci else None
+        return self._collapse(index, ci)
+
+    def ctc_greedy_decode_logits(self, logits: np.ndarray, keep_ci=False, chunk_size=256):
+        """直接对[N,T,C]的logits做批量贪婪解码，不计算完整的softmax。
+        softmax不改变argmax，被选中类别的概率为 exp(x_max - logsumexp(x)) = 1 / sum(exp(x - x_max))，
+        按chunk_size个时间步分块计算，只占用一小块临时内存。
+        识别结果与先做softmax完全一致；置信度在数学上等价，但浮点运算顺序不同，保留3位小数时个别值会在舍入边界上相差0.001。
+        """
+        logits = self._check(logits)
+        index = np.argmax(logits, -1)
+        if not keep_ci:
+            return self._collapse(index, None)
+        flat = logits.reshape(-1, logits.shape[-1])
+        x_max = np.take_along_axis(flat, index.reshape(-1, 1), -1)
+        ci = 1 / self._sum_exp(flat, x_max, chunk_size)
+        return self._collapse(index, ci.reshape(index.shape))
+
+    @staticmethod
+    def _sum_exp(flat: np.ndarray, x_max: np.ndarray, chunk_size=256) -> np.ndarray:
+        """逐行计算sum(exp(x - x_max))，分块复用同一块临时内存"""
+        out = np.empty(len(flat), dtype=flat.dtype)
+        buf = np.empty((min(chunk_size, len(flat)), flat.shape[-1]), dtype=flat.dtype)
+        for i in range(0, len(flat), chunk_size):
+            j = min(i + chunk_size, len(flat))
+            tmp = buf[: j - i]
+            np.subtract(flat[i:j], x_max[i:j], out=tmp)
+            np.exp(tmp, out=tmp)
+            out[i:j] = tmp.sum(-1)
+        return out
+
+    def ctc_prefix_beam_search(self, logits: np.ndarray, beam_size=10, nbest=1, topk=None):
+        """CTC前缀束搜索，输入单条[T,C]的logits，返回[(label, log概率)]共nbest个。
+        每个时间步只展开概率最高的topk个类别（默认等于beam_size），大词表下也很快。
+        """
+        logits = self._check(np.asarray(logits)[None])[0]
+        topk = min(topk or beam_size, logits.shape[-1])
+        # 只对topk个类别计算log_softmax
+        x_max = logits.max(-1, keepdims=True)
+        log_z = x_max[:, 0] + np.log(self._sum_exp(logits, x_max))
+        top_index = np.argpartition(-logits, topk - 1, axis=-1)[:, :topk]
+        top_logp = np.take_along_axis(logits, top_index, -1) - log_z[:, None]
+
+        # 前缀 -> [以空白结尾的log概率, 以非空白结尾的log概率]
+        beams = {(): (0.0, -math.inf)}
+        for indexes, logps in zip(top_index.tolist(), top_logp.tolist()):
+            next_beams = defaultdict(lambda: [-math.inf, -math.inf])
+            for prefix, (p_b, p_nb) in beams.items():
+                p_total = _log_add(p_b, p_nb)
+                last = prefix[-1] if prefix else None
+                for c, lp in zip(indexes, logps):
+                    if c == self.blank_index:
+                        entry = next_beams[prefix]
+                        entry[0] = _log_add(entry[0], p_total + lp)
+                    elif c == last:
+                        # 重复字符：不经空白时合并到原前缀，经空白分隔时才算新字符
+                        entry = next_beams[prefix]
+                        entry[1] = _log_add(entry[1], p_nb + lp)
+                        entry = next_beams[prefix + (c,)]
+                        entry[1] = _log_add(entry[1], p_b + lp)
+                    else:
+                        entry = next_beams[prefix + (c,)]
+                        entry[1] = _log_add(entry[1], p_total + lp)
+            ranked = sorted(next_beams.items(), key=lambda kv: _log_add(*kv[1]), reverse=True)
+            beams = dict(ranked[:beam_size])
+        ranked = sorted(((_log_add(*p), prefix) for prefix, p in beams.items()), reverse=True)
+        return [(self.vocabulary.decode(prefix), score) for score, prefix in ranked[:nbest]]
+
+    def _collapse(self, index: np.ndarray, ci=None):
+        """根据每个时间步的最佳索引（及置信度）得到标签"""
+        n, t = index.shape
+        # 每段连续重复索引的起点
+        start = np.ones((n, t), dtype=bool)
+        start[:, 1:] = index[:, 1:] != index[:, :-1]
+        # 删除连续的重复索引和空白索引
+        keep = start & (index != self.blank_index)
+        labels = ["".join(row) for row in np.where(keep, self._chars[index], "")]
+        if ci is None:
+            return labels
+        # 每个时间步的置信度先保留3位小数，再按段求平均
+        ci = np.round(ci.astype(np.float64), 3)
+        seg = np.cumsum(start.ravel()) - 1
+        seg_ci = np.bincount(seg, weights=ci.ravel()) / np.bincount(seg)
+        seg_index = index.ravel()[start.ravel()]
+        seg_keep = seg_index != self.blank_index
+        # 按样本切分各段
+        bounds = np.cumsum(start.sum(axis=1))[:-1]
+        results = []
+        for label, idx, c, k in zip(
+            labels, np.split(seg_index, bounds), np.split(seg_ci, bounds), np.split(seg_keep, bounds)
+        ):
+            results.append((label, list(zip(self._chars[idx[k]].tolist(), c[k].tolist()))))
+        return results
 
     def label_to_text(self, label):
         """标签转文字"""
-        return "".join([self.vocabulary[index] for index in label if index != -1])
+        return self.vocabulary.decode(label)
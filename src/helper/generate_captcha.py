@@ -15,6 +15,7 @@ from fontTools.ttLib import TTFont
 from PIL import Image, ImageDraw, ImageFont
 from scipy.interpolate import make_interp_spline
 from src import assets_path, vocabulary_path
+from src.helper.vocabulary import load_vocabulary
 
 
 class FontUtil:
@@ -65,9 +66,7 @@ class CaptchaGenerator:
         assert len(not_exists) == 0, f"字体文件{font2_path}不包含以下字符: {not_exists}"
 
     def _load_vocabulary(self):
-        with open(self.vocabulary_path, encoding="utf-8") as f:
-            vocabulary = f.readlines()
-        vocabulary = [w.strip() for w in vocabulary if w.strip()]
+        vocabulary = load_vocabulary(self.vocabulary_path)
 
         print(f"total vocabulary words: {len(vocabulary)}")
         return vocabulary
@@ -36,19 +36,21 @@ from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.figure import Figure
 
 
-def get_predict_label(host: str, img_path: str, channel: str):
-    assert channel in [
-        "red",
-        "blue",
-        "black",
-        "yellow",
-    ], f"channel {channel} is not supported!"
+def get_predict_label(host: str, img_path: str, channels: list):
+    """一次请求识别多个颜色通道，返回 {通道: 标签}"""
+    for channel in channels:
+        assert channel in [
+            "red",
+            "blue",
+            "black",
+            "yellow",
+        ], f"channel {channel} is not supported!"
 
     st = time.time()
     res = requests.post(
         host,
         files={"file": open(img_path, "rb")},
-        params={"channel": channel},
+        params={"channel": ",".join(channels)},
     )
     ed = time.time()
     assert res.status_code == 200, f"request failed, status code: {res.status_code}"
@@ -56,12 +58,12 @@ def get_predict_label(host: str, img_path: str, channel: str):
             res.json()["code"] == 0
     ), f"request failed, error message: {res.json()['error']}"
 
-    data = res.json()["data"]
-    pred_label = data["pred_label"]
-    pred_ci = data["pred_label"]
+    data = res.json()["data"]["channels"]
+    pred_label = {channel: data[channel]["predict_label"] for channel in channels}
+    pred_ci = {channel: data[channel]["ci"][-1][1] for channel in channels}
     logger.info(
         f"request time: {round(ed - st, 2)}s, filename: {os.path.basename(img_path)}, "
-        f"channel: {channel}, label: {pred_label}, pred_ci: {pred_ci}"
+        f"channels: {channels}, label: {pred_label}, pred_ci: {pred_ci}"
     )
     return pred_label
 
@@ -153,8 +155,8 @@ class TagDialog(QDialog):
         logger.info(
             f"start to get auto tag, filename: {os.path.basename(self.img_path)}"
         )
-        for color in self.inputs:
-            pred_label = get_predict_label(self.pred_host, self.img_path, color)
+        pred_labels = get_predict_label(self.pred_host, self.img_path, list(self.inputs))
+        for color, pred_label in pred_labels.items():
             if pred_label:
                 QMetaObject.invokeMethod(self.inputs[color], "setText", Qt.QueuedConnection, Q_ARG(str, pred_label), )
         logger.info(f"auto tag finished, filename: {os.path.basename(self.img_path)}")
@@ -0,0 +1,113 @@
+#! -*- coding: utf-8 -*-
+"""
+@Desc: 回放抓包文件压测本地服务，统计吞吐、延迟分位数和预测结果差异
+"""
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import numpy as np
+import requests
+from loguru import logger
+
+from src.app.capture import CaptureRecord, iter_records
+
+_local = threading.local()
+
+
+def extract_labels(body: bytes) -> List[str]:
+    """从JSON或NDJSON响应中按顺序提取所有predict_label"""
+    labels = []
+
+    def _walk(obj):
+        if isinstance(obj, dict):
+            for k, v in obj.items():
+                if k == "predict_label":
+                    labels.append(v)
+                else:
+                    _walk(v)
+        elif isinstance(obj, list):
+            for v in obj:
+                _walk(v)
+
+    for line in body.splitlines():
+        try:
+            _walk(json.loads(line))
+        except ValueError:
+            continue
+    return labels
+
+
+def _send(url: str, rec: CaptureRecord):
+    session = getattr(_local, "session", None)
+    if session is None:
+        session = _local.session = requests.Session()
+    headers = {"Content-Type": rec.content_type} if rec.content_type else {}
+    target = url.rstrip("/") + rec.path + (f"?{rec.query}" if rec.query else "")
+    st = time.perf_counter()
+    try:
+        resp = session.post(target, data=rec.body, headers=headers)
+        status, content = resp.status_code, resp.content
+    except requests.RequestException as e:
+        status, content = 0, str(e).encode()
+    return status, (time.perf_counter() - st) * 1000, content
+
+
+def _percentiles(values, qs=(50, 90, 99)):
+    if len(values) == 0:
+        return {f"p{q}": 0.0 for q in qs}
+    return {f"p{q}": round(float(np.percentile(values, q)), 3) for q in qs}
+
+
+def replay(url: str, capture_path: str, speed: float = 1.0, concurrency: int = 16, limit: int = 0, show_diff: int = 10):
+    """回放抓包文件
+    speed: 回放倍速，按原始请求间隔除以speed发送，小于等于0时不等待，以最大并发发送
+    concurrency: 客户端并发数
+    limit: 最多回放的请求数，0为不限
+    """
+    records = sorted(iter_records(capture_path), key=lambda rec: rec.time)
+    if limit > 0:
+        records = records[:limit]
+    assert records, f"no records in {capture_path}"
+    logger.info(f"Replay {len(records)} requests to {url}, speed: {speed}, concurrency: {concurrency}")
+
+    t0 = records[0].time
+    futures = []
+    st = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for rec in records:
+            if speed > 0:
+                # 按原始到达间隔发送，保留真实流量的突发特征
+                delay = (rec.time - t0) / speed - (time.perf_counter() - st)
+                if delay > 0:
+                    time.sleep(delay)
+            futures.append(pool.submit(_send, url, rec))
+        results = [fut.result() for fut in futures]
+    elapsed = time.perf_counter() - st
+
+    latency = np.array([lat for status, lat, _ in results if status == 200])
+    errors = sum(1 for status, _, _ in results if status != 200)
+    status_diff, label_diff = 0, 0
+    for rec, (status, _, content) in zip(records, results):
+        if status != rec.status:
+            status_diff += 1
+            continue
+        old, new = extract_labels(rec.response), extract_labels(content)
+        if old != new:
+            label_diff += 1
+            if label_diff <= show_diff:
+                logger.warning(f"diff {rec.path}?{rec.query}: {old} -> {new}")
+    report = {
+        "requests": len(records),
+        "errors": errors,
+        "elapsed": round(elapsed, 3),
+        "throughput": round(len(records) / elapsed, 2),
+        "latency_ms": {**_percentiles(latency), "max": round(float(latency.max()), 3) if len(latency) else 0.0},
+        "captured_latency_ms": _percentiles(np.array([rec.latency_ms for rec in records])),
+        "status_diff": status_diff,
+        "label_diff": label_diff,
+    }
+    logger.info(f"Replay report: {json.dumps(report)}")
+    return report
@@ -10,7 +10,8 @@ from pathlib import Path
 
 import numpy as np
 from PIL import Image
-from paddle.vision.transforms import transforms
+
+from src.helper.vocabulary import Vocabulary, load_vocabulary
 
 
 class DataUtil:
@@ -24,31 +25,17 @@ class DataUtil:
         self.std = np.array([0.23375643, 0.23862716, 0.23951546])
         self.mean = np.array([0.55456273, 0.5225813, 0.51677391])
 
+        self.img_size = (120, 50)  # (宽, 高)
         self.channels = ["red", "blue", "black", "yellow", "text"]
-        self.transform = transforms.Compose(
-            [
-                transforms.Normalize(mean=self.mean, std=self.std),
-                # transforms.RandomPerspective(),
-                # transforms.RandomAffine(degrees=15,
-                #                         translate=(0.05, 0.05),
-                #                         scale=(0.8, 1.1),
-                #                         shear=15)
-            ]
-        )
-
-    def _load_vocabulary(self):
-        if self.simple_mode:
-            return list("0123456789abcdefghijklmnopqrstuvwxyz".upper())
-        with open(self.vocabulary_path, encoding="utf-8") as f:
-            vocabulary = f.readlines()
-        vocabulary = [w.strip() for w in vocabulary if w.strip()]
-        return vocabulary
-
-    def get_vocabulary(self):
-        return self._load_vocabulary()
+        # 像素值到归一化结果的查找表，[3, 256]，等价于 (x / 255 - mean) / std
+        self.lut = ((np.arange(256) / 255.0 - self.mean[:, None]) / self.std[:, None]).astype(np.float32)
+
+    def get_vocabulary(self) -> Vocabulary:
+        # 进程内共享同一份词表
+        return load_vocabulary(self.vocabulary_path, self.simple_mode)
 
     def get_vocabulary_dict(self):
-        return {t: i for i, t in enumerate(self._load_vocabulary())}
+        return self.get_vocabulary().to_dict()
 
     def restore_img(self, img_arr: np.ndarray):
         """img_arr恢复为图片对象"""
@@ -58,15 +45,34 @@ class DataUtil:
 
     def restore_label(self, label):
         """label恢复为text"""
-        voca = self.get_vocabulary()
-        return "".join(voca[i] for i in label if i != -1)
+        return self.get_vocabulary().decode(label)
 
-    def process_img(self, img: Image):
-        # 图片加载&转换
+    def load_rgb(self, img: Image) -> np.ndarray:
+        """图片转为uint8的HWC像素数组，尺寸不一致时缩放到模型输入大小"""
         img = img.convert("RGB")
-        img_arr = np.array(img, np.float32).transpose([2, 0, 1]) / 255.0
-        img_arr = self.transform(img_arr)
-        return img_arr
+        if img.size != self.img_size:
+            img = img.resize(self.img_size)
+        return np.asarray(img)
+
+    def process_rgb(self, rgb: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        """uint8的HWC像素逐通道查表，直接写入CHW的float32数组，out为可选的预分配缓冲区"""
+        if out is None:
+            out = np.empty((3, *rgb.shape[:2]), dtype=np.float32)
+        for c in range(3):
+            np.take(self.lut[c], rgb[:, :, c], out=out[c])
+        return out
+
+    def process_batch(self, rgbs: list, out: np.ndarray = None) -> np.ndarray:
+        """多张uint8的HWC像素写入[N,3,H,W]的batch，out为可选的预分配缓冲区"""
+        if out is None:
+            out = np.empty((len(rgbs), 3, *rgbs[0].shape[:2]), dtype=np.float32)
+        for rgb, arr in zip(rgbs, out):
+            self.process_rgb(rgb, arr)
+        return out
+
+    def process_img(self, img: Image, out: np.ndarray = None) -> np.ndarray:
+        # 图片加载&转换
+        return self.process_rgb(self.load_rgb(img), out)
 
     def process_channel(self, channel: str):
         # 颜色信息处理
@@ -76,15 +82,18 @@ class DataUtil:
 
     def process_label(self, label: str):
         # 标签处理
-        voca_dict = self.get_vocabulary_dict()
-        label_seq = [voca_dict[t] for t in label]
-        if len(label_seq) < self.max_len:
-            label_seq += [-1] * (self.max_len - len(label_seq))
-        label_arr = np.array(label_seq).astype("int32")
-        return label_arr
+        return self.get_vocabulary().encode(label, self.max_len)
 
 
 class ImageUtil:
+    # 各颜色的像素判定规则，(r, g, b)依次为True表示该分量高于upper，False表示低于lower
+    color_rules = {
+        "red": (True, False, False),
+        "blue": (False, False, True),
+        "black": (False, False, False),
+        "yellow": (True, True, False),
+    }
+
     def __init__(self, path: Path):
         self.path = path
         self.red_channel = None
@@ -94,49 +103,21 @@ class ImageUtil:
 
         self.split_channel()
 
+    @classmethod
+    def mask_channel(cls, img_arr: np.ndarray, channel: str, upper: int = 220, lower: int = 60) -> np.ndarray:
+        """只保留指定颜色的像素，其余像素置为白色，返回新数组"""
+        assert channel in cls.color_rules, f"channel only can be one of {list(cls.color_rules)}"
+        rgb = img_arr[:, :, :3]
+        keep = np.where(cls.color_rules[channel], rgb > upper, rgb < lower).all(axis=-1)
+        masked = img_arr.copy()
+        masked[~keep] = 255
+        return masked
+
     def split_channel(self, upper: int = 220, lower: int = 60):
-        img = Image.open(self.path)
-
-        img_red = np.array(img.copy())
-        img_red[
-            ~(
-                (img_red[:, :, 0] > upper)
-                & (img_red[:, :, 1] < lower)
-                & (img_red[:, :, 2] < lower)
-            )
-        ] = 255
-        self.red_channel = Image.fromarray(img_red)
-
-        img_blue = np.array(img.copy())
-        img_blue[
-            ~(
-                (img_blue[:, :, 0] < lower)
-                & (img_blue[:, :, 1] < lower)
-                & (img_blue[:, :, 2] > upper)
-            )
-        ] = 255
-
-        self.blue_channel = Image.fromarray(img_blue)
-
-        img_black = np.array(img.copy())
-        img_black[
-            ~(
-                (img_black[:, :, 0] < lower)
-                & (img_black[:, :, 1] < lower)
-                & (img_black[:, :, 2] < lower)
-            )
-        ] = 255
-        self.black_channel = Image.fromarray(img_black)
-
-        img_yellow = np.array(img.copy())
-        img_yellow[
-            ~(
-                (img_yellow[:, :, 0] > upper)
-                & (img_yellow[:, :, 1] > upper)
-                & (img_yellow[:, :, 2] < lower)
-            )
-        ] = 255
-        self.yellow_channel = Image.fromarray(img_yellow)
+        img_arr = np.array(Image.open(self.path))
+        for channel in self.color_rules:
+            masked = self.mask_channel(img_arr, channel, upper, lower)
+            setattr(self, f"{channel}_channel", Image.fromarray(masked))
 
     def get_channel(self, channel: str):
         assert channel in [
@@ -0,0 +1,95 @@
+#! -*- coding: utf-8 -*-
+"""
+@Desc: 词表，每个进程只加载一次，id与字符的双向查表都由数组完成
+"""
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterable, List, Sequence
+
+import numpy as np
+
+SIMPLE_CHARS = "0123456789abcdefghijklmnopqrstuvwxyz".upper()
+
+
+class Vocabulary:
+    """不可变词表
+    id2char: 索引到字符的数组，末尾多一个空串，-1（补齐位）和空白索引都解码为空串
+    char2id: 以unicode码位为下标的数组，不在词表中的字符为-1
+    """
+
+    def __init__(self, chars: Sequence[str]):
+        self.chars = tuple(chars)
+        assert all(len(c) == 1 for c in self.chars), "vocabulary item must be a single character"
+        self.id2char = np.array(self.chars + ("",))
+        self.id2char.setflags(write=False)
+        codes = self._codes("".join(self.chars))
+        self.char2id = np.full(int(codes.max()) + 1 if len(codes) else 0, -1, dtype=np.int32)
+        self.char2id[codes] = np.arange(len(codes), dtype=np.int32)
+        self.char2id.setflags(write=False)
+
+    def __len__(self):
+        return len(self.chars)
+
+    def __getitem__(self, index):
+        return self.chars[index]
+
+    def __iter__(self):
+        return iter(self.chars)
+
+    def __contains__(self, char):
+        return char in self.chars
+
+    @staticmethod
+    def _codes(text: str) -> np.ndarray:
+        return np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
+
+    def to_dict(self) -> dict:
+        return {c: i for i, c in enumerate(self.chars)}
+
+    def encode(self, text: str, max_len: int = 0) -> np.ndarray:
+        """文字转id，长度不足max_len时用-1补齐"""
+        codes = self._codes(text)
+        ids = np.full(max(len(codes), max_len), -1, dtype=np.int32)
+        ids[: len(codes)] = self._lookup(codes, text)
+        return ids
+
+    def encode_batch(self, texts: Sequence[str], max_len: int) -> np.ndarray:
+        """一批文字转为[N,max_len]的id数组，用-1补齐"""
+        codes = self._codes("".join(texts))
+        lengths = np.array([len(t) for t in texts], dtype=np.int64)
+        assert len(lengths) == 0 or lengths.max() <= max_len, f"text longer than max_len {max_len}"
+        rows = np.repeat(np.arange(len(texts)), lengths)
+        cols = np.arange(len(codes)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        ids = np.full((len(texts), max_len), -1, dtype=np.int32)
+        ids[rows, cols] = self._lookup(codes, texts)
+        return ids
+
+    def _lookup(self, codes: np.ndarray, text) -> np.ndarray:
+        ids = np.full(len(codes), -1, dtype=np.int32)
+        known = codes < len(self.char2id)
+        ids[known] = self.char2id[codes[known]]
+        if (ids < 0).any():
+            missing = sorted({chr(c) for c in codes[ids < 0]})
+            raise KeyError(f"characters {missing} of {text} not in vocabulary")
+        return ids
+
+    def decode(self, ids: Iterable[int]) -> str:
+        """id转文字，跳过-1"""
+        return "".join(self.id2char[np.asarray(ids, dtype=np.int64)])
+
+    def decode_batch(self, ids: np.ndarray) -> List[str]:
+        """[N,L]的id数组转为N个文字，跳过-1"""
+        return ["".join(row) for row in self.id2char[np.asarray(ids, dtype=np.int64)]]
+
+
+@lru_cache(maxsize=None)
+def _load(path: str, simple_mode: bool) -> Vocabulary:
+    if simple_mode:
+        return Vocabulary(SIMPLE_CHARS)
+    with open(path, encoding="utf-8") as f:
+        return Vocabulary([w.strip() for w in f if w.strip()])
+
+
+def load_vocabulary(path, simple_mode: bool = False) -> Vocabulary:
+    """加载词表，同一进程内相同路径只读取一次"""
+    return _load(str(Path(path).absolute()), simple_mode)
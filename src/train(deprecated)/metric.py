@@ -25,13 +25,12 @@ class WordsErrorRate(Metric):
 
     def update(self, outputs, labels):
         """更新统计指标"""
-        if not isinstance(outputs, paddle.Tensor):
-            outputs = paddle.to_tensor(outputs)
-        outputs = paddle.nn.functional.softmax(outputs, axis=-1)
-        # 解码获取识别结果
-        for output, label in zip(outputs, labels):
-            pred_text = self.decoder.ctc_greedy_decoder(output)
-            label_text = self.decoder.label_to_text(label)
+        if isinstance(outputs, paddle.Tensor):
+            outputs = outputs.numpy()
+        # 直接在logits上整批解码获取识别结果，argmax不需要softmax
+        pred_texts = self.decoder.ctc_greedy_decode_logits(outputs)
+        label_texts = self.decoder.vocabulary.decode_batch(labels)
+        for pred_text, label_text in zip(pred_texts, label_texts):
             if random.random() < 0.01:
                 # 按照1%概率打印最多10个样本
                 self.samples.append({"pred": pred_text, "label": label_text})
@@ -84,13 +83,12 @@ class SampleAccuracy(Metric):
 
     def update(self, outputs, labels):
         """更新统计指标"""
-        if not isinstance(outputs, paddle.Tensor):
-            outputs = paddle.to_tensor(outputs)
-        outputs = paddle.nn.functional.softmax(outputs, axis=-1)
-        # 解码获取识别结果
-        for output, label in zip(outputs, labels):
-            pred_text = self.decoder.ctc_greedy_decoder(output)
-            label_text = self.decoder.label_to_text(label)
+        if isinstance(outputs, paddle.Tensor):
+            outputs = outputs.numpy()
+        # 直接在logits上整批解码获取识别结果，argmax不需要softmax
+        pred_texts = self.decoder.ctc_greedy_decode_logits(outputs)
+        label_texts = self.decoder.vocabulary.decode_batch(labels)
+        for pred_text, label_text in zip(pred_texts, label_texts):
             # 计算样本正确率
             self.value += int(pred_text == label_text)
             self.count += 1